@@ -0,0 +1,225 @@
+import time
+import asyncio
+
+from Proto import Proto
+from Proto32 import Proto32
+from ProtoError import ProtoError
+from Exchange import ExchangeTimeout, window_limit
+from MemoryImage import MemoryImage, as_image
+
+class AsyncProtoBase:
+    """
+    Common part of asyncio protocol clients.
+    Requests are generated by a synchronous protocol object in batch
+    mode (it never touches the port) and exchanged over asyncio streams.
+    Each call builds its whole batch before the first await, so calls
+    from many tasks can be mixed freely; the wire is used by one
+    exchange at a time. Batches skip pointer loads assuming the batches
+    queued before them went through, when one of them fails the
+    following ones load the pointer they assumed (see batch_resync()).
+
+    reader, writer: asyncio streams of the serial port
+    proto: Proto/Proto32 object without a port
+    timeout: seconds without any progress
+    """
+    def __init__(self, reader, writer, proto, timeout=1):
+        self.reader = reader
+        self.writer = writer
+        self.proto = proto
+        self.timeout = timeout
+        self.lock = asyncio.Lock()
+        # device address pointer after the last exchanged batch
+        self.device_ptr = proto.pointer_state()
+
+    def addr_format(self, addr):
+        return self.proto.addr_format(addr)
+
+    def value_format(self, value):
+        return self.proto.value_format(value)
+
+    async def exchange(self, req, rsp_len, window=None, req_ends=None, rsp_ends=None):
+        # same as Exchange.exchange, sending is done by a separate task
+        # so that responses are read while the request is still going out
+        # (called with the lock held)
+        req = memoryview(req)
+        rsp = memoryview(bytearray(rsp_len))
+        written = 0
+        received = 0
+        answered = asyncio.Event()
+
+        async def send():
+            nonlocal written
+            while written < len(req):
+                limit = window_limit(len(req), received, window, req_ends, rsp_ends)
+                if written < limit:
+                    self.writer.write(req[written:limit])
+                    written = limit
+                    await self.writer.drain()
+                else:
+                    answered.clear()
+                    await answered.wait()
+
+        sender = asyncio.create_task(send())
+        try:
+            while received < rsp_len:
+                try:
+                    data = await asyncio.wait_for(self.reader.read(rsp_len - received), self.timeout)
+                except asyncio.TimeoutError:
+                    if sender.done() and sender.exception():
+                        raise sender.exception()
+                    raise ExchangeTimeout("timeout", written, len(req), received, rsp_len)
+
+                if not data:
+                    raise ProtoError("exchange: port closed")
+
+                rsp[received:received+len(data)] = data
+                received += len(data)
+                answered.set()
+
+            return rsp
+
+        finally:
+            sender.cancel()
+
+    async def flush(self):
+        # exchanges the queued batch, returns its response
+        batch = self.proto.batch_take()
+        end = self.proto.pointer_state()
+
+        async with self.lock:
+            batch, skip = self.proto.batch_resync(batch, self.device_ptr)
+            if skip and self.proto.stats is not None:
+                # the load put in front of the batch
+                self.proto.stats.seeks += 1
+            t1 = time.perf_counter()
+            try:
+                echo = await self.exchange_batch(batch)
+                if self.proto.stats is not None:
+                    self.proto.stats.record(self.proto.batch_opcodes(batch), len(batch[0]), len(echo), time.perf_counter() - t1, flush=True)
+                self.proto.batch_check(batch, echo)
+            except Exception as e:
+                # device may have stopped anywhere in the batch
+                self.proto.invalidate_pointer()
+                self.device_ptr = self.proto.pointer_state()
+                if self.proto.stats is not None and isinstance(e, ExchangeTimeout):
+                    # a failed flush counts too, with what got through
+                    self.proto.stats.record(self.proto.batch_opcodes(batch, e.written), e.written, e.received, time.perf_counter() - t1, flush=True, failed=True)
+                raise
+    
+            self.device_ptr = end
+
+        return echo[skip:]
+
+    def batch(self):
+        # starts a batch, returns the protocol object
+        # to generate requests with (no awaits until flush())
+        self.proto.batch()
+        return self.proto
+
+    async def call(self, func_name, *args):
+        # single protocol function as a batch
+        self.proto.batch()
+        getattr(self.proto, func_name)(*args)
+        return await self.flush()
+
+    async def write_memory(self, data):
+        # data: MemoryImage or {addr: byte}
+        self.proto.batch()
+        self.proto.queue_write_memory(as_image(data))
+        await self.flush()
+
+    async def read_memory_image(self, image):
+        # reads memory covered by image, returns new image
+        self.proto.batch()
+        spans = self.proto.queue_read_image(image)
+        rsp = await self.flush()
+
+        return MemoryImage.from_spans(spans, rsp)
+
+    async def read_memory(self, addresses):
+        self.proto.batch()
+        offsets = self.proto.queue_read_memory(addresses)
+        rsp = await self.flush()
+
+        return {addr: rsp[i] for addr, i in offsets.items()}
+
+    async def run_cycles(self, cycles):
+        await self.call("run_cycles", cycles)
+
+    async def pulse_cpu_reset(self):
+        await self.call("pulse_cpu_reset")
+
+    async def perform_cpu_reset(self):
+        await self.call("perform_cpu_reset")
+
+    async def set_free_run(self, enabled):
+        await self.call("set_free_run", enabled)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+class AsyncProto(AsyncProtoBase):
+    def __init__(self, reader, writer, timeout=1):
+        super().__init__(reader, writer, Proto(None), timeout)
+
+    async def exchange_batch(self, batch):
+        req = batch[0]
+        return await self.exchange(req, len(req))
+
+    async def get(self, name):
+        # see Proto.get
+        self.proto.batch()
+        try:
+            value = self.proto.queue_get(name)
+        except ValueError:
+            self.proto.batch_reset()
+            raise
+
+        return value(await self.flush())
+
+    async def snapshot(self, names):
+        # see Proto.snapshot
+        self.proto.batch()
+        try:
+            values = self.proto.queue_snapshot(names)
+        except ValueError:
+            self.proto.batch_reset()
+            raise
+
+        rsp = await self.flush()
+        return {name: value(rsp) for name, value in values.items()}
+
+
+class AsyncProto32(AsyncProtoBase):
+    def __init__(self, reader, writer, timeout=1, window=None):
+        super().__init__(reader, writer, Proto32(None, window), timeout)
+
+    async def exchange_batch(self, batch):
+        req, rsp_len, req_ends, rsp_ends, checks, bptr = batch
+        return await self.exchange(req, rsp_len, self.proto.window, req_ends, rsp_ends)
+
+    async def write_memory(self, data):
+        # bytes next to the data in partly covered words are
+        # read first and written back unchanged
+        image = as_image(data)
+        words = image.partial_words(4)
+        known = None
+        if words:
+            known = await self.read_memory([w + k for w in words for k in range(4)])
+        await super().write_memory(image.aligned(4, known=known))
+
+
+"""
+Open an asyncio client on a serial port
+(requires pyserial-asyncio)
+"""
+async def open_proto(port, baudrate, d32=False, timeout=1, window=None):
+    import serial_asyncio
+
+    reader, writer = await serial_asyncio.open_serial_connection(url=port, baudrate=baudrate)
+    if d32:
+        return AsyncProto32(reader, writer, timeout, window)
+
+    return AsyncProto(reader, writer, timeout)
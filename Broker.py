@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import socket
+import argparse
+import selectors
+
+from Cache import cache_path
+
+# max bytes moved in one relay step
+RELAY_CHUNK = 4096
+
+# max bytes from the port waiting for a slow client
+RELAY_BUFFER = 0x10000
+
+# seconds a new client has to send its handshake
+HANDSHAKE_TIMEOUT = 2
+
+def socket_path(port):
+    # Unix socket of the broker owning <port>
+    return cache_path("broker", port, suffix=".sock")
+
+
+class BrokerPort:
+    """
+    Client end of a broker session, behaves like a serial.Serial
+    (write/read/readinto/fileno/timeouts) so protocols and the
+    exchange engine use it unchanged. The port is exclusively
+    ours until close().
+
+    sock: connected Unix socket (handshake done)
+    timeout: read timeout [seconds]
+    """
+    def __init__(self, sock, timeout=1):
+        self.sock = sock
+        self.timeout = timeout
+        self.write_timeout = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def write(self, data):
+        # timeout 0 -- non-blocking, returns bytes written (like pyserial)
+        if self.write_timeout == 0:
+            self.sock.settimeout(0)
+            try:
+                return self.sock.send(data)
+            except BlockingIOError:
+                return 0
+
+        self.sock.settimeout(self.write_timeout)
+        self.sock.sendall(data)
+        return len(data)
+
+    def readinto(self, b):
+        # timeout 0 -- returns what's already received
+        b = memoryview(b)
+        n = 0
+        end = None if self.timeout is None else time.monotonic() + self.timeout
+        while n < len(b):
+            wait = None if end is None else max(0, end - time.monotonic())
+            self.sock.settimeout(wait)
+            try:
+                k = self.sock.recv_into(b[n:])
+            except (BlockingIOError, socket.timeout):
+                break
+            if not k:
+                # broker gone
+                break
+            n += k
+
+        return n
+
+    def read(self, n):
+        buf = bytearray(n)
+        k = self.readinto(buf)
+        return bytes(buf[:k])
+
+    def close(self):
+        self.sock.close()
+
+
+"""
+Connect to the broker of <port> if it's running
+returns BrokerPort (after the broker switched to <baudrate>
+and dropped stale input) or None
+"""
+def connect(port, baudrate, timeout=1):
+    path = socket_path(port)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+
+    # waits while another client holds the port
+    sock.sendall(f"{baudrate}\n".encode())
+    reply = b""
+    while not reply.endswith(b"\n"):
+        data = sock.recv(64)
+        if not data:
+            sock.close()
+            return None
+        reply += data
+
+    if reply != b"OK\n":
+        sock.close()
+        raise OSError(f"broker: {reply.decode(errors='replace').strip()}")
+
+    return BrokerPort(sock, timeout)
+
+
+class Broker:
+    """
+    Owns an open serial port and relays it to clients connecting
+    over a Unix socket, one client at a time (others wait in
+    the listen queue). Data goes both ways as it arrives, so
+    pipelined batches stream like on a local port.
+
+    ser: open serial port
+    path: socket path
+    """
+    def __init__(self, ser, path):
+        self.ser = ser
+        self.path = path
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+
+    def handshake(self, conn):
+        # "<baud>\n" -> "OK\n", port is clean afterwards
+        # a silent client is dropped after HANDSHAKE_TIMEOUT
+        conn.settimeout(HANDSHAKE_TIMEOUT)
+        line = b""
+        while not line.endswith(b"\n"):
+            try:
+                data = conn.recv(64)
+            except (socket.timeout, ConnectionResetError):
+                return False
+            if not data or len(line) > 64:
+                return False
+            line += data
+
+        try:
+            baudrate = int(line)
+        except ValueError:
+            conn.sendall(b"invalid handshake\n")
+            return False
+
+        if self.ser.baudrate != baudrate:
+            self.ser.baudrate = baudrate
+        self.ser.reset_input_buffer()
+        conn.sendall(b"OK\n")
+        return True
+
+    def session(self, conn):
+        # relays until the client disconnects
+        ORIG_T  = self.ser.timeout
+        ORIG_WT = self.ser.write_timeout
+        self.ser.timeout = 0
+        self.ser.write_timeout = 0
+        conn.setblocking(False)
+
+        to_port = bytearray()
+        to_client = bytearray()
+        buf = memoryview(bytearray(RELAY_CHUNK))
+        sel = selectors.DefaultSelector()
+        fd = self.ser.fileno()
+
+        # events waited for, nothing is read while its buffer is full
+        # (level-triggered select would return right away)
+        interest = {conn: 0, fd: 0}
+        def watch(fileobj, events):
+            if interest[fileobj] == events:
+                return
+            if not events:
+                sel.unregister(fileobj)
+            elif not interest[fileobj]:
+                sel.register(fileobj, events)
+            else:
+                sel.modify(fileobj, events)
+            interest[fileobj] = events
+
+        try:
+            while True:
+                watch(conn, (selectors.EVENT_READ if len(to_port) < RELAY_CHUNK else 0) |
+                            (selectors.EVENT_WRITE if to_client else 0))
+                watch(fd, (selectors.EVENT_READ if len(to_client) < RELAY_BUFFER else 0) |
+                          (selectors.EVENT_WRITE if to_port else 0))
+
+                for key, mask in sel.select():
+                    if key.fileobj is conn:
+                        if mask & selectors.EVENT_READ:
+                            data = conn.recv(RELAY_CHUNK)
+                            if not data:
+                                return
+                            to_port += data
+                        if mask & selectors.EVENT_WRITE:
+                            n = conn.send(to_client)
+                            del to_client[:n]
+                    else:
+                        if mask & selectors.EVENT_READ:
+                            n = self.ser.readinto(buf[:RELAY_BUFFER - len(to_client)])
+                            to_client += buf[:n or 0]
+                        if mask & selectors.EVENT_WRITE:
+                            n = self.ser.write(to_port[:RELAY_CHUNK])
+                            del to_port[:n or 0]
+
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+        finally:
+            sel.close()
+            self.ser.timeout = ORIG_T
+            self.ser.write_timeout = ORIG_WT
+
+    def serve(self):
+        try:
+            while True:
+                conn, _ = self.sock.accept()
+                with conn:
+                    if self.handshake(conn):
+                        self.session(conn)
+        finally:
+            self.close()
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def get_args():
+    p = argparse.ArgumentParser(description="Keep the serial port open for debug.py runs")
+    p.add_argument("-p", "--port", help="serial port to use", required=False, default="/dev/ttyUSB0")
+    p.add_argument("-b", "--baudrate", help="initial baud of serial (clients switch it)", required=False, default=115200, metavar="BAUD")
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    import serial
+
+    args = get_args()
+    ser = serial.Serial(args.port, args.baudrate, timeout=1)
+    broker = Broker(ser, socket_path(args.port))
+    print(f"broker: {args.port} at {broker.path}")
+    try:
+        broker.serve()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,29 @@
+import os
+import re
+import hashlib
+
+"""
+Directory for files kept between runs
+($XDG_CACHE_HOME/debug_uart/<sub>, created if needed)
+"""
+def cache_dir(*sub):
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "debug_uart", *sub)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_path(sub, *key, suffix=""):
+    # file in cache_dir(sub) of <key> (strings), named readably
+    # plus a hash of the exact key, so keys never share a file
+    readable = re.sub(r"[^A-Za-z0-9]+", "_", "_".join(key)).strip("_")
+    digest = hashlib.sha1("\0".join(key).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir(sub), f"{readable}-{digest}{suffix}")
+
+
+def write_atomic(path, data):
+    # readers never see a partially written file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
@@ -0,0 +1,140 @@
+import time
+import bisect
+import selectors
+
+# max bytes handed to the port in one write call
+# (pyserial copies the data it is given)
+WRITE_CHUNK = 4096
+
+# poll interval for ports without a file descriptor
+POLL_INTERVAL = 0.0005
+
+class ExchangeTimeout(TimeoutError):
+    """
+    Raised when the device stopped answering or the exchange
+    didn't finish in time, carries the progress made so far
+    """
+    def __init__(self, reason, written, req_len, received, rsp_len):
+        super().__init__(f"exchange {reason}: written {written} / {req_len}, "
+                         f"received {received} / {rsp_len} bytes")
+        self.written = written
+        self.req_len = req_len
+        self.received = received
+        self.rsp_len = rsp_len
+
+
+def window_limit(req_len, received, window, req_ends, rsp_ends):
+    # how far the request can be sent with <received> response bytes
+    # so that at most <window> bytes stay unanswered
+    if window is None:
+        return req_len
+    
+    # requests fully answered
+    k = bisect.bisect_right(rsp_ends, received)
+    acked = req_ends[k-1] if k else 0
+    return min(req_len, acked + window)
+
+
+def port_fd(ser):
+    # file descriptor to wait on, None if the port doesn't have one
+    try:
+        return ser.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+"""
+Exchange large amounts of data with the device
+    ser: serial port (anything with pyserial-like write/readinto/timeouts)
+    req: request bytes
+    rsp_len: expected response length
+    window: max bytes sent but not yet answered (None -- unlimited),
+            req_ends/rsp_ends (cumulative lengths at every request end)
+            are used to find out how much of the data was answered
+    deadline: seconds for the whole exchange (None -- unlimited)
+    idle: seconds without any progress (None -- port timeout)
+Waits for the port with selectors (like poll() in cfast),
+response is received in place and returned as a memoryview.
+Port timeouts are always restored.
+"""
+def exchange(ser, req, rsp_len, window=None, req_ends=None, rsp_ends=None, deadline=None, idle=None):
+    ORIG_T  = ser.timeout
+    ORIG_WT = ser.write_timeout
+    if idle is None:
+        idle = ORIG_T
+
+    ser.timeout = 0
+    ser.write_timeout = 0
+
+    sel = None
+    fd = port_fd(ser)
+    if fd is not None:
+        sel = selectors.DefaultSelector()
+
+    try:
+        req = memoryview(req)
+        rsp = memoryview(bytearray(rsp_len))
+        written = 0
+        received = 0
+        events = 0
+
+        start = time.monotonic()
+        last = start
+        while received < rsp_len:
+            limit = window_limit(len(req), received, window, req_ends, rsp_ends)
+
+            now = time.monotonic()
+            wait = None
+            if deadline is not None:
+                wait = start + deadline - now
+                if wait <= 0:
+                    raise ExchangeTimeout("deadline exceeded", written, len(req), received, rsp_len)
+            if idle is not None:
+                left = last + idle - now
+                if left <= 0:
+                    raise ExchangeTimeout("timeout", written, len(req), received, rsp_len)
+                wait = left if wait is None else min(wait, left)
+
+            want = selectors.EVENT_READ
+            if written < limit:
+                want |= selectors.EVENT_WRITE
+
+            if sel is None:
+                ready = want
+            else:
+                if want != events:
+                    if events:
+                        sel.modify(fd, want)
+                    else:
+                        sel.register(fd, want)
+                    events = want
+
+                ready = 0
+                for key, mask in sel.select(wait):
+                    ready |= mask
+
+            progress = False
+            if ready & selectors.EVENT_WRITE:
+                n = ser.write(req[written:min(limit, written+WRITE_CHUNK)])
+                if n:
+                    written += n
+                    progress = True
+
+            if ready & selectors.EVENT_READ:
+                n = ser.readinto(rsp[received:])
+                if n:
+                    received += n
+                    progress = True
+
+            if progress:
+                last = time.monotonic()
+            elif sel is None:
+                time.sleep(POLL_INTERVAL)
+
+        return rsp
+
+    finally:
+        if sel is not None:
+            sel.close()
+        ser.timeout = ORIG_T
+        ser.write_timeout = ORIG_WT
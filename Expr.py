@@ -0,0 +1,99 @@
+import functools
+
+# register name -> (function reading it, byte of its response)
+REGISTERS = {
+    "A":  ("get_A_S", 0),
+    "S":  ("get_A_S", 1),
+    "X":  ("get_X_Y", 0),
+    "Y":  ("get_X_Y", 1),
+    "IR": ("get_IR_P", 0),
+    "P":  ("get_IR_P", 1),
+}
+
+class Expr:
+    """
+    Compiled get() expression (see compile_expr())
+    requests: register requests needed (Proto function names)
+    addresses: memory addresses needed
+    value(): extracts the value from a batch response given
+             the response offsets of the requests/addresses
+    """
+    requests = ()
+    addresses = ()
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r})"
+
+    def value(self, rsp, reg_offsets, mem_offsets):
+        raise NotImplementedError()
+
+
+class Register(Expr):
+    def __init__(self, name):
+        super().__init__(name)
+        self.func, self.byte = REGISTERS[name]
+        self.requests = (self.func,)
+
+    def value(self, rsp, reg_offsets, mem_offsets):
+        return rsp[reg_offsets[self.func] + self.byte]
+
+
+class ProgramCounter(Expr):
+    requests = ("get_PC",)
+
+    def value(self, rsp, reg_offsets, mem_offsets):
+        i = reg_offsets["get_PC"]
+        return rsp[i+1] * 256 + rsp[i]
+
+
+class Memory(Expr):
+    def __init__(self, name, addr):
+        super().__init__(name)
+        self.addr = addr
+        self.addresses = (addr,)
+
+    def value(self, rsp, reg_offsets, mem_offsets):
+        return rsp[mem_offsets[self.addr]]
+
+
+class Bit(Expr):
+    def __init__(self, name, reg, bit):
+        super().__init__(name)
+        self.reg = reg
+        self.bit = bit
+        self.requests = reg.requests
+        self.addresses = reg.addresses
+
+    def value(self, rsp, reg_offsets, mem_offsets):
+        return (self.reg.value(rsp, reg_offsets, mem_offsets) >> self.bit) & 0x01
+
+
+"""
+Compile get() expression (see Proto.get() for syntax)
+Parsed once per name, repeated calls return the same object.
+Raises ValueError for unknown names.
+"""
+@functools.lru_cache(maxsize=None)
+def compile_expr(name):
+    if name in REGISTERS:
+        return Register(name)
+
+    if name == "PC":
+        return ProgramCounter(name)
+
+    try:
+        if name.startswith("M"):
+            addr = int(name.split("(")[1].split(")")[0], 16)
+            return Memory(name, addr)
+
+        if name.startswith("B"):
+            reg, bit = name.split("(")[1].split(")")[0].split(",")
+            return Bit(name, compile_expr(reg.strip()), int(bit.strip()))
+
+    except IndexError:
+        pass
+
+    raise ValueError("no such field")
@@ -0,0 +1,137 @@
+import os
+import struct
+import hashlib
+
+from MemoryImage import MemoryImage
+from Cache import cache_dir, write_atomic
+
+# record types
+R_DATA        = 0x00
+R_EOF         = 0x01
+R_EXT_SEGMENT = 0x02
+R_EXT_LINEAR  = 0x04
+
+# cache entry starts with size and mtime of the parsed file
+CACHE_KEY = struct.Struct("<QQ")
+
+"""
+Parse Intel HEX records from text lines
+yields (start, bytearray) of contiguous data,
+consecutive records are joined (like gen_bitstream in cfast)
+"""
+def ihex_segments(lines, name="ihex"):
+    base = 0
+    run_start = None
+    run = bytearray()
+
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            if not line.startswith(":"):
+                raise ValueError("not a record")
+            rec = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ValueError(f"{name}:{lineno}: invalid record")
+
+        if len(rec) < 5 or len(rec) != rec[0] + 5:
+            raise ValueError(f"{name}:{lineno}: record length not matching")
+        if sum(rec) & 0xFF:
+            raise ValueError(f"{name}:{lineno}: checksum error")
+
+        rtype = rec[3]
+        if rtype == R_DATA:
+            addr = base + (rec[1] << 8 | rec[2])
+            if run_start is not None and run_start + len(run) == addr:
+                run += rec[4:-1]
+            else:
+                if run_start is not None:
+                    yield run_start, run
+                run_start = addr
+                run = bytearray(rec[4:-1])
+
+        elif rtype == R_EOF:
+            break
+
+        elif rtype == R_EXT_SEGMENT:
+            base = int.from_bytes(rec[4:6], "big") << 4
+
+        elif rtype == R_EXT_LINEAR:
+            base = int.from_bytes(rec[4:6], "big") << 16
+
+        # start address records don't carry memory data
+
+    if run_start is not None:
+        yield run_start, run
+
+
+def ihex_record(rtype, addr, data):
+    rec = bytes([len(data), addr >> 8 & 0xFF, addr & 0xFF, rtype]) + bytes(data)
+    return ":" + (rec + bytes([-sum(rec) & 0xFF])).hex().upper()
+
+
+"""
+Intel HEX text lines of image (record data length up to <record>)
+records never cross 64 KiB pages, extended linear address
+records are emitted when the page changes
+"""
+def ihex_lines(image, record=16):
+    return ihex_stream(image.segments(), record)
+
+
+"""
+Intel HEX text lines of (start, data) pieces in address order,
+pieces are consumed as they come (eg. read from the device)
+"""
+def ihex_stream(segments, record=16):
+    page = 0
+    for start, data in segments:
+        offset = 0
+        while offset < len(data):
+            addr = start + offset
+            if addr >> 16 != page:
+                page = addr >> 16
+                yield ihex_record(R_EXT_LINEAR, 0, page.to_bytes(2, "big"))
+
+            n = min(record, len(data) - offset, 0x10000 - (addr & 0xFFFF))
+            yield ihex_record(R_DATA, addr & 0xFFFF, data[offset:offset+n])
+            offset += n
+
+    yield ihex_record(R_EOF, 0, b"")
+
+
+"""
+Load Intel HEX file as MemoryImage
+With cache set, the parsed image is kept on disk (keyed by path,
+size and mtime of the file), repeated loads skip parsing.
+"""
+def load_ihex(path, cache=True):
+    st = os.stat(path)
+    key = CACHE_KEY.pack(st.st_size, st.st_mtime_ns)
+
+    entry = None
+    if cache:
+        try:
+            name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+            entry = os.path.join(cache_dir("ihex"), name)
+            with open(entry, "rb") as f:
+                data = f.read()
+            if data[:CACHE_KEY.size] == key:
+                return MemoryImage.load(memoryview(data)[CACHE_KEY.size:])
+        except (OSError, ValueError, struct.error):
+            pass
+
+    image = MemoryImage()
+    with open(path) as f:
+        for start, data in ihex_segments(f, os.path.basename(path)):
+            image.add(start, data, copy=False)
+
+    if entry is not None:
+        try:
+            write_atomic(entry, key + image.dump())
+        except OSError:
+            pass
+
+    return image
@@ -0,0 +1,353 @@
+import bisect
+import struct
+
+# block size used when looking for mismatches
+COMPARE_BLOCK = 256
+
+# serialized image: magic, segment count, then (start, length, data) each
+DUMP_MAGIC = b"DBGI"
+DUMP_HEADER = struct.Struct("<4sI")
+DUMP_SEGMENT = struct.Struct("<QI")
+
+class MemoryImage:
+    """
+    Memory contents as sorted, non-overlapping segments
+    of consecutive bytes (start address, bytearray).
+    Touching segments are always joined into one
+    (except in images made by aligned()).
+    """
+    def __init__(self):
+        self.starts = []
+        self.datas = []
+
+    @classmethod
+    def from_bytes(cls, addr, data):
+        img = cls()
+        img.add(addr, data)
+        return img
+
+    @classmethod
+    def from_buffer(cls, addr, buf):
+        # image of a single segment backed by buf without copying
+        # (eg. mmap, memory stays in the file until accessed)
+        img = cls()
+        img.add(addr, memoryview(buf), copy=False)
+        return img
+
+    @classmethod
+    def from_dict(cls, data_dict):
+        # {addr: byte} -> image
+        img = cls()
+        run_start = None
+        run = bytearray()
+        for addr in sorted(data_dict):
+            if run_start is not None and run_start + len(run) != addr:
+                img.add(run_start, run)
+                run = bytearray()
+                run_start = None
+
+            if run_start is None:
+                run_start = addr
+            run.append(data_dict[addr])
+
+        if run_start is not None:
+            img.add(run_start, run)
+
+        return img
+
+    @classmethod
+    def from_spans(cls, spans, rsp):
+        # [(start, length, response offset)] -> image
+        img = cls()
+        for addr, length, offset in spans:
+            img.add(addr, rsp[offset:offset+length])
+
+        return img
+
+    @classmethod
+    def load(cls, buf):
+        # deserializes dump(), segments are views of buf (no copying)
+        buf = memoryview(buf)
+        magic, count = DUMP_HEADER.unpack_from(buf)
+        if magic != DUMP_MAGIC:
+            raise ValueError("not a memory image dump")
+
+        img = cls()
+        offset = DUMP_HEADER.size
+        for _ in range(count):
+            start, length = DUMP_SEGMENT.unpack_from(buf, offset)
+            offset += DUMP_SEGMENT.size
+            if offset + length > len(buf):
+                raise ValueError("truncated memory image dump")
+
+            img.add(start, buf[offset:offset+length], copy=False)
+            offset += length
+
+        return img
+
+    def dump(self):
+        # compact binary form, see load()
+        parts = [DUMP_HEADER.pack(DUMP_MAGIC, len(self.starts))]
+        for start, data in self.segments():
+            parts.append(DUMP_SEGMENT.pack(start, len(data)))
+            parts.append(data)
+
+        return b"".join(parts)
+
+    def __len__(self):
+        # number of bytes
+        return sum(len(data) for data in self.datas)
+
+    def __contains__(self, addr):
+        i = bisect.bisect_right(self.starts, addr) - 1
+        return i >= 0 and addr < self.starts[i] + len(self.datas[i])
+
+    def __getitem__(self, addr):
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i < 0 or addr >= self.starts[i] + len(self.datas[i]):
+            raise KeyError(addr)
+
+        return self.datas[i][addr - self.starts[i]]
+
+    def segments(self):
+        # iterate (start, memoryview of data)
+        for start, data in zip(self.starts, self.datas):
+            yield start, memoryview(data)
+
+    def pieces(self, size):
+        # iterate images of at most <size> bytes covering this one,
+        # small segments share a piece, big ones are split
+        # (size may be a function, called before every piece)
+        # pieces share data with this image
+        piece = MemoryImage()
+        room = None
+        for start, data in self.segments():
+            offset = 0
+            while offset < len(data):
+                if room is None:
+                    room = size() if callable(size) else size
+                n = min(room, len(data) - offset)
+                piece.add(start + offset, data[offset:offset+n], copy=False)
+                offset += n
+                room -= n
+                if not room:
+                    yield piece
+                    piece = MemoryImage()
+                    room = None
+
+        if piece.starts:
+            yield piece
+
+    def addresses(self):
+        for start, data in zip(self.starts, self.datas):
+            yield from range(start, start + len(data))
+
+    def items(self):
+        # iterate (addr, byte), mind the per-byte cost
+        for start, data in zip(self.starts, self.datas):
+            yield from zip(range(start, start + len(data)), data)
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def get(self, addr, length):
+        # memoryview of <length> bytes at <addr>
+        # (must be inside one segment)
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i < 0 or addr + length > self.starts[i] + len(self.datas[i]):
+            raise KeyError(addr)
+
+        offset = addr - self.starts[i]
+        return memoryview(self.datas[i])[offset:offset+length]
+
+    def add(self, addr, data, copy=True):
+        # writes data at addr, overwriting what was there (overlay)
+        # copy=False keeps data itself if it becomes a separate segment
+        end = addr + len(data)
+        if end == addr:
+            return
+
+        # first segment ending at or after addr (touching joins)
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i < 0 or self.starts[i] + len(self.datas[i]) < addr:
+            i += 1
+
+        # segments i..j-1 touch [addr, end]
+        j = i
+        while j < len(self.starts) and self.starts[j] <= end:
+            j += 1
+
+        if i == j:
+            self.starts.insert(i, addr)
+            self.datas.insert(i, bytearray(data) if copy else data)
+            return
+
+        start = self.starts[i]
+        if i+1 == j and start <= addr:
+            # inside or extending a single segment
+            if not isinstance(self.datas[i], bytearray):
+                self.datas[i] = bytearray(self.datas[i])
+            self.datas[i][addr-start:end-start] = data
+            return
+
+        start = min(start, addr)
+        last = self.starts[j-1] + len(self.datas[j-1])
+        buf = bytearray(max(end, last) - start)
+        for k in range(i, j):
+            offset = self.starts[k] - start
+            buf[offset:offset+len(self.datas[k])] = self.datas[k]
+        buf[addr-start:end-start] = data
+
+        self.starts[i:j] = [start]
+        self.datas[i:j] = [buf]
+
+    def overlay(self, other):
+        # other's bytes take precedence
+        for start, data in other.segments():
+            self.add(start, data)
+
+    def merge(self, other):
+        # union of both images, overlapping bytes have to match
+        for start, data in other.segments():
+            ranges = self.compare_segment(start, data, missing=False)
+            if ranges:
+                raise ValueError(f"merge: images differ at ${ranges[0][0]:x}")
+
+        self.overlay(other)
+
+    def partial_words(self, word=4):
+        # addresses of words only partly covered by this image
+        words = set()
+        for start, data in self.segments():
+            end = start + len(data)
+            words.add(start - start % word)
+            words.add((end - 1) - (end - 1) % word)
+
+        return sorted(w for w in words if not all(a in self for a in range(w, w + word)))
+
+    def aligned(self, word=4, fill=0, known=None):
+        # new image with segments extended to whole words,
+        # padding filled with <fill> or taken from <known>
+        # ({addr: byte}, eg. read from the device)
+        # only partly covered words are new buffers, they are kept
+        # as separate segments touching the rest, which is shared
+        # with this image (not copied, eg. an mmap stays in the file)
+        edges = {}
+        for start, data in self.segments():
+            end = start + len(data)
+            for w in (start - start % word, (end - 1) - (end - 1) % word):
+                if w in edges or (w >= start and w + word <= end):
+                    continue
+                buf = bytearray([fill]) * word
+                for k in range(word):
+                    if w + k in self:
+                        buf[k] = self[w + k]
+                    elif known and w + k in known:
+                        buf[k] = known[w + k]
+                edges[w] = buf
+
+        pieces = list(edges.items())
+        for start, data in self.segments():
+            end = start + len(data)
+            a = -(-start // word) * word
+            b = end - end % word
+            if a < b:
+                pieces.append((a, data[a-start:b-start]))
+
+        img = MemoryImage()
+        for start, data in sorted(pieces, key=lambda piece: piece[0]):
+            img.starts.append(start)
+            img.datas.append(data)
+
+        return img
+
+    def changed(self, base, word=1):
+        # image of whole words of this image which differ from base
+        # (or are missing there), shares data with this image
+        img = MemoryImage()
+        for start, data in self.segments():
+            end = start + len(data)
+            for a, b in base.compare_segment(start, data):
+                a = max(start, a - a % word)
+                b = min(end, -(-b // word) * word)
+                img.add(a, data[a-start:b-start])
+
+        return img
+
+    def compare_segment(self, start, data, missing=True):
+        # ranges [a, b) where data at start differs from this image
+        # (bytes missing in this image differ if <missing> is set)
+        ranges = []
+        end = start + len(data)
+        addr = start
+        while addr < end:
+            i = bisect.bisect_right(self.starts, addr) - 1
+            if i < 0 or addr >= self.starts[i] + len(self.datas[i]):
+                # not covered up to the next segment
+                nxt = self.starts[i+1] if i+1 < len(self.starts) else end
+                if missing:
+                    ranges.append((addr, min(nxt, end)))
+                addr = min(nxt, end)
+                continue
+
+            seg_start = self.starts[i]
+            seg_end = min(end, seg_start + len(self.datas[i]))
+            mine = memoryview(self.datas[i])[addr-seg_start:seg_end-seg_start]
+            theirs = data[addr-start:seg_end-start]
+            ranges.extend(mismatches(mine, theirs, addr))
+            addr = seg_end
+
+        return join_ranges(ranges)
+
+    def differing(self, spans, rsp):
+        # image of response bytes (spans like in from_spans)
+        # which differ from this image
+        img = MemoryImage()
+        for addr, length, offset in spans:
+            for a, b in self.compare_segment(addr, rsp[offset:offset+length]):
+                img.add(a, rsp[offset+a-addr:offset+b-addr])
+
+        return img
+
+    def compare(self, other):
+        # ranges [a, b) where other differs from this image
+        ranges = []
+        for start, data in self.segments():
+            ranges.extend(other.compare_segment(start, data))
+
+        return join_ranges(ranges)
+
+
+def mismatches(a, b, base):
+    # ranges [base+x, base+y) where equal length buffers a, b differ
+    ranges = []
+    for block in range(0, len(a), COMPARE_BLOCK):
+        end = min(len(a), block + COMPARE_BLOCK)
+        if a[block:end] == b[block:end]:
+            continue
+
+        for k in range(block, end):
+            if a[k] != b[k]:
+                ranges.append((base + k, base + k + 1))
+
+    return join_ranges(ranges)
+
+
+def join_ranges(ranges):
+    # joins touching [a, b) ranges of a sorted list
+    joined = []
+    for a, b in ranges:
+        if joined and joined[-1][1] == a:
+            joined[-1] = (joined[-1][0], b)
+        else:
+            joined.append((a, b))
+
+    return joined
+
+
+def as_image(data):
+    # accepts MemoryImage or {addr: byte}
+    if isinstance(data, MemoryImage):
+        return data
+
+    return MemoryImage.from_dict(data)
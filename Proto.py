@@ -1,14 +1,55 @@
 FILL = 0x00
 
 from ProtoError import ProtoError
+from Exchange import exchange, ExchangeTimeout
+from MemoryImage import MemoryImage, as_image
+from Expr import compile_expr
+
+# bytes sent in one batch when streaming memory (4 KiB)
+CHUNK = 0x1000
+
+# opcode -> request name (for statistics)
+OPCODES = {
+    0x01: "set_address_pointer_low",
+    0x02: "set_address_pointer_high",
+    0x03: "get_address_pointer",
+    0x04: "write_memory_1_byte",
+    0x05: "read_memory_2_byte",
+    0x10: "get_A_S",
+    0x11: "get_X_Y",
+    0x12: "get_IR_P",
+    0x13: "get_PC",
+    0x20: "run_cycles",
+    0x21: "perform_cpu_reset",
+    0x22: "set_free_run",
+}
 
 import sys
+import time
+import functools
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 class Proto:
     def __init__(self, ser):
         self.ser = ser
+        # Shadow of device memory, invalidated when the CPU runs
+        self.shadow = None
+        # Stats collecting wire statistics (None -- disabled)
+        self.stats = None
+        # model of the device address pointer bytes after all
+        # requests sent or queued so far (None -- unknown)
+        self.alow = None
+        self.ahigh = None
+        self.batch_reset()
+        
+    def batch_reset(self):
+        self.bmode = False
+        self.bdata = bytearray()
+        # (offset, length, func_name) of requests which should be echoed
+        self.bchecks = []
+        # address pointer model (low, high) when the batch started
+        self.bptr = (None, None)
         
     def addr_format(self, addr):
         return f"{addr:04x}"
@@ -16,69 +57,239 @@ class Proto:
     def value_format(self, value):
         return f"{value:02x}"
         
-    def request_with_echo(self, func_name, req):
-        # used when sending requests with no data to be read
-        # (device should echo the request)
-        # this function verifies that the echo matches what was sent
+    def request(self, func_name, req, check=False):
+        # used when sending requests (all kind)
+        # every request is 2 bytes long and is answered with 2 bytes
+        # (less -> timeout error)
+        # if check is set, verifies that the device echoed the request
         data = bytes(req)
+        
+        if self.bmode:
+            if check:
+                self.bchecks.append((len(self.bdata), 2, func_name))
+            self.bdata += data
+            return bytes()
+        
+        if self.stats is not None:
+            t1 = time.perf_counter()
+        
         self.ser.write(data)
         
         echo = self.ser.read(2)
+        
+        if self.stats is not None:
+            self.stats.record(data[:1], 2, len(echo), time.perf_counter() - t1)
         echo_len = len(echo)
         echo_arr = [d for d in echo]
         if echo_len < 2:
             eprint(f"\ntimeout occured, received {echo_len} / 2 bytes: {echo_arr}")
             
+            self.invalidate_pointer()
             raise TimeoutError(f"{func_name}: timeout")
             
-        if echo != data:
+        if check and echo != data:
+            self.invalidate_pointer()
             eprint(f"\n{func_name}: echo not matching")
             eprint(f"should be: {req}")
             eprint(f"is: {echo_arr}")
             
             raise ProtoError(f"{func_name}: echo not matching")
         
+        return echo
+        
+    def request_with_echo(self, func_name, req):
+        # used when sending requests with no data to be read
+        # (device should echo the request)
+        self.request(func_name, req, check=True)
+        
+    def request_bulk(self, func_name, req, check=False):
+        # queues many consecutive requests at once (batch mode only)
+        # req is the concatenation of 2 byte requests
+        if not self.bmode:
+            raise ProtoError(f"{func_name}: bulk requests need batch mode")
+        
+        if check:
+            self.bchecks.append((len(self.bdata), len(req), func_name))
+        self.bdata += req
+    
+    def exchange(self, req, rsp_len, deadline=None):
+        # exchange large amounts of data, see Exchange.exchange
+        return exchange(self.ser, req, rsp_len, deadline=deadline)
+    
+    def batch(self):
+        # Batch mode, requests accumulate in memory
+        # execute and response collection in flush()
+        # below protocol functions stay the same and
+        # can be used in request generation as usual
+        # (of course except their return values)
+        if not self.bmode:
+            self.bptr = self.pointer_state()
+        self.bmode = True
+        
+    def batch_address(self, bdata, end, ptr=(None, None)):
+        # replays the address pointer changes of requests
+        # in bdata[:end] starting from <ptr> (low, high),
+        # returns the pointer value at <end>
+        # (None if the batch did not load it before)
+        alow, ahigh = ptr
+        for i in range(0, end, 2):
+            func, arg = bdata[i], bdata[i+1]
+            if func == 0x01:
+                alow = arg
+            elif func == 0x02:
+                ahigh = arg
+            elif func in (0x04, 0x05):
+                if alow is None or ahigh is None:
+                    alow = ahigh = None
+                    continue
+                
+                a = (ahigh * 256 + alow + (1 if func == 0x04 else 2)) % 0x10000
+                alow, ahigh = a % 256, a // 256
+        
+        if alow is None or ahigh is None:
+            return None
+        
+        return ahigh * 256 + alow
+        
+    def batch_take(self):
+        # hands over the queued batch and leaves batch mode
+        # (request, echo checks, pointer at batch start)
+        batch = (self.bdata, self.bchecks, self.bptr)
+        self.batch_reset()
+        return batch
+        
+    def batch_opcodes(self, batch, sent=None):
+        # opcode of every batch request
+        # (of requests started within <sent> bytes)
+        return batch[0][0:sent:2]
+        
+    def batch_resync(self, batch, device):
+        # the batch skipped pointer loads assuming the pointer bytes
+        # were as at its start, with <device> (low, high) being
+        # different, loads of the assumed bytes are put in front
+        # returns (batch, response bytes of the added loads)
+        bdata, bchecks, bptr = batch
+        seek = bytearray()
+        for op, assumed, actual in zip((0x01, 0x02), bptr, device):
+            if assumed is not None and assumed != actual:
+                seek += bytes([op, assumed])
+        
+        if not seek:
+            return batch, 0
+        
+        n = len(seek)
+        checks = [(0, n, "set_address_pointer")] + [(offset + n, length, func) for offset, length, func in bchecks]
+        return (seek + bdata, checks, (None, None)), n
+        
+    def batch_check(self, batch, echo):
+        # verifies the response of a batch, all echoes at once
+        bdata, bchecks, bptr = batch
+        if len(echo) != len(bdata):
+            eprint("\nbatch flush: response length not matching")
+            eprint(f"should be: {len(bdata)}, is: {len(echo)}")
+            raise ProtoError("batch flush: response length not matching")
+        
+        for offset, length, func_name in bchecks:
+            if echo[offset:offset+length] == bdata[offset:offset+length]:
+                continue
+            
+            # first failing request
+            i = offset
+            while echo[i:i+2] == bdata[i:i+2]:
+                i += 2
+            
+            addr = self.batch_address(bdata, i, bptr)
+            where = "?" if addr is None else f"${self.addr_format(addr)}"
+            eprint(f"\n{func_name}: echo not matching at {where}")
+            eprint(f"should be: {list(bdata[i:i+2])}")
+            eprint(f"is: {list(echo[i:i+2])}")
+            
+            raise ProtoError(f"{func_name}: echo not matching at {where}")
+        
+    def flush(self, deadline=None):
+        # sends all requests back-to-back,
+        # then verifies all echoes at once
+        # deadline: seconds for the whole exchange (None -- unlimited)
+        # device inactivity is limited by the port timeout
+        batch = self.batch_take()
+        if self.stats is not None:
+            t1 = time.perf_counter()
+        
+        try:
+            echo = self.exchange(batch[0], len(batch[0]), deadline)
+            
+            if self.stats is not None:
+                self.stats.record(self.batch_opcodes(batch), len(batch[0]), len(echo), time.perf_counter() - t1, flush=True)
+            self.batch_check(batch, echo)
+        except Exception as e:
+            # device may have stopped anywhere in the batch
+            self.invalidate_pointer()
+            if self.stats is not None and isinstance(e, ExchangeTimeout):
+                # a failed flush counts too, with what got through
+                self.stats.record(self.batch_opcodes(batch, e.written), e.written, e.received, time.perf_counter() - t1, flush=True, failed=True)
+            raise
+        
+        return echo
+    
+    # address pointer model
+    def invalidate_pointer(self):
+        self.alow = None
+        self.ahigh = None
+        
+    def pointer_state(self):
+        # model as stored with batches (low, high)
+        return (self.alow, self.ahigh)
+        
+    def advance_pointer(self, n):
+        # pointer moved by n bytes (reads/writes)
+        if self.alow is None or self.ahigh is None:
+            self.invalidate_pointer()
+            return
+        
+        a = (self.ahigh * 256 + self.alow + n) % 0x10000
+        self.alow, self.ahigh = a % 256, a // 256
+    
     # protocol functions
     def set_address_pointer_low(self, alow):
+        self.alow = alow
         self.request_with_echo("set_address_pointer_low", [0x01, alow])
         
     def set_address_pointer_high(self, ahigh):
+        self.ahigh = ahigh
         self.request_with_echo("set_address_pointer_high", [0x02, ahigh])
         
     def get_address_pointer(self):
-        self.ser.write(bytes([0x03, FILL]))
-        alow, ahigh = self.ser.read(2)
-        return ahigh * 256 + alow
+        self.alow, self.ahigh = self.request("get_address_pointer", [0x03, FILL])
+        return self.ahigh * 256 + self.alow
         
     def write_memory_1_byte(self, b):
+        self.advance_pointer(1)
         self.request_with_echo("write_memory_1_byte", [0x04, b])
         
     def read_memory_2_byte(self):
-        self.ser.write(bytes([0x05, FILL]))
-        return self.ser.read(2)
+        self.advance_pointer(2)
+        return self.request("read_memory_2_byte", [0x05, FILL])
         
     def get_A_S(self):
-        self.ser.write(bytes([0x10, FILL]))
-        return self.ser.read(2)
+        return self.request("get_A_S", [0x10, FILL])
         
     def get_X_Y(self):
-        self.ser.write(bytes([0x11, FILL]))
-        return self.ser.read(2)
+        return self.request("get_X_Y", [0x11, FILL])
         
     def get_IR_P(self):
-        self.ser.write(bytes([0x12, FILL]))
-        return self.ser.read(2)
+        return self.request("get_IR_P", [0x12, FILL])
         
     def get_PC(self):
-        self.ser.write(bytes([0x13, FILL]))
-        pclow, pchigh = self.ser.read(2)
+        pclow, pchigh = self.request("get_PC", [0x13, FILL])
         return pchigh * 256 + pclow
         
     def run_cycles(self, cycles):
+        self.cpu_may_run()
         self.request_with_echo("run_cycles", [0x20, cycles])
         
     def pulse_cpu_reset(self):
         # only pulls reset down for 1 cycle
+        self.cpu_may_run()
         self.request_with_echo("perform_cpu_reset", [0x21, FILL])
 
     def perform_cpu_reset(self):
@@ -88,51 +299,201 @@ class Proto:
         self.run_cycles(8)
         
     def set_free_run(self, enabled):
+        self.cpu_may_run()
         self.request_with_echo("set_free_run", [0x22, enabled])
     
     
     # public interface functions
+    def queue_write_verify(self, image):
+        # queues writes of image, each segment followed by
+        # its read-back (batch mode), returns spans like queue_read_image
+        spans = []
+        for addr, data in image.segments():
+            piece = MemoryImage.from_buffer(addr, data)
+            self.queue_write_memory(piece)
+            spans += self.queue_read_image(piece)
+        
+        return spans
+        
+    def cpu_may_run(self):
+        # memory may change behind our back,
+        # shadow copy is no longer valid
+        # (nor is the address pointer model)
+        if self.shadow is not None:
+            self.shadow.invalidate()
+        self.invalidate_pointer()
+        
     def set_address_pointer(self, a):
-        self.set_address_pointer_low(a % 256)
-        self.set_address_pointer_high(a // 256)
+        # only pointer bytes differing from the model are sent
+        if self.alow == a % 256 and self.ahigh == a // 256:
+            return
+        if self.stats is not None:
+            self.stats.seeks += 1
+        if self.alow != a % 256:
+            self.set_address_pointer_low(a % 256)
+        if self.ahigh != a // 256:
+            self.set_address_pointer_high(a // 256)
         
-    def write_memory_dict(self, data_dict):
-        lastaddr = -1000
-        for addr, val in data_dict.items():
-            if lastaddr+1 != addr:
-                print(f"loading adr_ptr with ${addr:04x}")
-                self.set_address_pointer(addr)
+    def write_memory_bytes(self, data):
+        # queues consecutive 1 byte writes of data (batch mode only)
+        req = bytearray(2 * len(data))
+        req[0::2] = bytes([0x04]) * len(data)
+        req[1::2] = data
+        self.advance_pointer(len(data))
+        self.request_bulk("write_memory_1_byte", req, check=True)
+        
+    def read_memory_bytes(self, n):
+        # queues reads of n consecutive bytes (batch mode only)
+        # every read returns 2 bytes, response may have one byte more
+        self.advance_pointer((n+1) // 2 * 2)
+        self.request_bulk("read_memory_2_byte", bytes([0x05, FILL]) * ((n+1) // 2))
+        
+    def queue_write_memory(self, image):
+        # queues requests writing image (batch mode)
+        for addr, data in image.segments():
+            self.set_address_pointer(addr)
+            self.write_memory_bytes(data)
+        
+    def queue_read_image(self, image):
+        # queues reads of all segments of image (batch mode)
+        # returns [(start, length, response offset)]
+        spans = []
+        for addr, data in image.segments():
+            spans.append((addr, len(data), self.queue_read_range(addr, len(data))))
+        
+        return spans
+        
+    def queue_read_range(self, addr, n):
+        # queues reads of n bytes at addr (batch mode)
+        # returns response offset of the first byte
+        self.set_address_pointer(addr)
+        offset = len(self.bdata)
+        self.read_memory_bytes(n)
+        return offset
+        
+    def queue_read_memory(self, addresses):
+        # queues reads of all addresses (batch mode),
+        # every read returns 2 consecutive bytes
+        # returns {addr: offset of its byte in the response}
+        offsets = {}
+        for addr in sorted(set(addresses)):
+            if addr in offsets:
+                # second byte of previous read
+                continue
             
-            #print(f"${addr:04x}  ${val:02x}")
-            self.write_memory_1_byte(val)
+            # skipped when the pointer is already there
+            self.set_address_pointer(addr)
             
-            lastaddr = addr
+            offsets[addr] = len(self.bdata)
+            offsets[addr+1] = len(self.bdata) + 1
+            self.read_memory_2_byte()
         
-    def read_memory_dict(self, addresses):
-        mem_dict = {addr: -1 for addr in addresses}
+        return {addr: offsets[addr] for addr in addresses}
         
-        lastaddr = -1000
-        i = 0
-        while i < len(addresses):
-            addr = addresses[i]
-            
-            if lastaddr+2 != addr:
+    def queue_snapshot(self, names):
+        # queues requests needed to get all <names> (batch mode),
+        # every register pair and memory word is requested once
+        # returns {name: function extracting its value from the response}
+        # (see get() for names, compiled expressions are cached)
+        exprs = {name: compile_expr(name) for name in names}
+        
+        reg_offsets = {}
+        addresses = set()
+        for expr in exprs.values():
+            reg_offsets.update(dict.fromkeys(expr.requests))
+            addresses.update(expr.addresses)
+        
+        for func in reg_offsets:
+            reg_offsets[func] = len(self.bdata)
+            if func == "get_PC":
+                # get_PC() unpacks its response
+                self.request("get_PC", [0x13, FILL])
+            else:
+                getattr(self, func)()
+        
+        mem_offsets = self.queue_read_memory(sorted(addresses))
+        
+        return {name: functools.partial(expr.value, reg_offsets=reg_offsets, mem_offsets=mem_offsets)
+                for name, expr in exprs.items()}
+        
+    def queue_get(self, name):
+        # queues requests needed to get <name> (batch mode)
+        # returns a function extracting the value from the response
+        return self.queue_snapshot([name])[name]
+        
+    def write_memory_image(self, image, chunk=CHUNK):
+        # streams the image in batches of at most <chunk> bytes
+        # (small segments share a batch),
+        # memory use doesn't depend on the image size
+        starts = set(image.starts)
+        for piece in image.pieces(chunk):
+            for addr in sorted(starts.intersection(piece.starts)):
                 print(f"loading adr_ptr with ${addr:04x}")
-                self.set_address_pointer(addr)
-            
-            val1, val2 = self.read_memory_2_byte()
-            # print(f"${addr:04x}:  ${val1:02x} ${val2:02x}")
-            mem_dict[addr] = val1
-            mem_dict[addr+1] = val2
-            
-            if i+1 < len(addresses) and addr+1 == addresses[i+1]:
-                i += 1
+            self.batch()
+            self.queue_write_memory(piece)
+            self.flush()
+        
+    def write_memory_dict(self, data_dict):
+        self.write_memory_image(as_image(data_dict))
+        
+    def read_memory_image(self, image):
+        # reads memory covered by image, returns new image
+        self.batch()
+        spans = self.queue_read_image(image)
+        rsp = self.flush()
+        
+        return MemoryImage.from_spans(spans, rsp)
+        
+    def read_memory_stream(self, addr, n, chunk=CHUNK):
+        # reads n bytes at addr in batches of at most <chunk> bytes,
+        # yields (start, memoryview) pieces in address order,
+        # memory use doesn't depend on n
+        end = addr + n
+        while addr < end:
+            size = min(chunk, end - addr)
+            self.batch()
+            offset = self.queue_read_range(addr, size)
+            rsp = self.flush()
             
-            lastaddr = addr
-            i += 1
+            yield addr, rsp[offset:offset+size]
+            addr += size
+        
+    def verify_memory_image(self, image, chunk=CHUNK):
+        # reads back the image in batches of at most <chunk> bytes
+        # returns image of device memory differing from image (empty if ok)
+        diff = MemoryImage()
+        for piece in image.pieces(chunk):
+            self.batch()
+            spans = self.queue_read_image(piece)
+            diff.overlay(piece.differing(spans, self.flush()))
+        
+        return diff
+        
+    def write_verify_image(self, image, chunk=CHUNK):
+        # writes and reads back the image in one pass, every batch
+        # carries writes and read-backs of at most <chunk> bytes
+        # returns image of device memory differing from image (empty if ok)
+        diff = MemoryImage()
+        starts = set(image.starts)
+        for piece in image.pieces(chunk):
+            for addr in sorted(starts.intersection(piece.starts)):
+                print(f"loading adr_ptr with ${addr:04x}")
+            self.batch()
+            spans = self.queue_write_verify(piece)
+            diff.overlay(piece.differing(spans, self.flush()))
+        
+        return diff
         
-        return mem_dict
+    def read_memory_dict(self, addresses):
+        self.batch()
+        offsets = self.queue_read_memory(addresses)
+        rsp = self.flush()
+        
+        return {addr: rsp[i] for addr, i in offsets.items()}
     
+    def print_stats(self):
+        print(self.stats.report(OPCODES))
+        
     def print_status(self):
         A, S  = self.get_A_S()
         X, Y  = self.get_X_Y()
@@ -155,33 +516,38 @@ class Proto:
         B(<register>, <bit>) -- read <register> <bit> value
     """
     def get(self, name):
-        if name == "A":
-            return self.get_A_S()[0]
-        if name == "X":
-            return self.get_X_Y()[0]
-        if name == "Y":
-            return self.get_X_Y()[1]
-        if name == "S":
-            return self.get_A_S()[1]
-        
-        if name == "IR":
-            return self.get_IR_P()[0]
-        if name == "P":
-            return self.get_IR_P()[1]
-        if name == "PC":
-            return self.get_PC()
-            
-        if name.startswith("M"):
-            addr = int(name.split("(")[1].split(")")[0], 16)
+        # one or two requests, sent directly (a batch round trip
+        # costs more than it saves here), see snapshot() for many names
+        expr = compile_expr(name)
+        
+        rsp = bytearray()
+        reg_offsets = {}
+        for func in expr.requests:
+            reg_offsets[func] = len(rsp)
+            if func == "get_PC":
+                # get_PC() unpacks its response
+                rsp += self.request("get_PC", [0x13, FILL])
+            else:
+                rsp += getattr(self, func)()
+        
+        mem_offsets = {}
+        for addr in expr.addresses:
             self.set_address_pointer(addr)
-            return self.read_memory_2_byte()[0]
+            mem_offsets[addr] = len(rsp)
+            rsp += self.read_memory_2_byte()
         
-        if name.startswith("B"):
-            reg, bit = name.split("(")[1].split(")")[0].split(",")
-            val = self.get(reg.strip())
-            bit = int(bit.strip())
-            return (val >> bit) & 0x01
-            
-        raise ValueError("no such field")
+        return expr.value(rsp, reg_offsets, mem_offsets)
+        
+    def snapshot(self, names):
+        # gets all <names> (see get()) in one batch
+        # returns {name: value}
+        self.batch()
+        try:
+            values = self.queue_snapshot(names)
+        except ValueError:
+            self.batch_reset()
+            raise
+        
+        rsp = self.flush()
+        return {name: value(rsp) for name, value in values.items()}
         
-
@@ -1,9 +1,13 @@
 from ProtoError import ProtoError
+from Exchange import exchange, ExchangeTimeout
+from MemoryImage import MemoryImage, as_image
 
 import struct
-from collections import defaultdict
+import bisect
+from array import array
 
 import sys
+import time
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
@@ -16,15 +20,98 @@ I_CPU_RESET   = 0x21
 I_CPU_FREERUN = 0x22
 OK = 0x01
 
+# bytes sent in one batch when streaming memory (64 KiB),
+# multiple of 4
+CHUNK = 0x10000
+
+# longest request (address pointer set / memory write)
+MAX_REQ_LEN = 5
+
+# attempts of a failed batch when tuning
+RETRIES = 3
+
+# quiet time ending the drain after a failed batch [seconds]
+DRAIN_IDLE = 0.05
+
+# opcode -> request name (for statistics)
+OPCODES = {
+    I_ADR_PTR_SET: "set_address_pointer",
+    I_ADR_PTR_GET: "get_address_pointer",
+    I_MEM_WR:      "write_memory_4_byte",
+    I_MEM_RD:      "read_memory_4_byte",
+    I_CPU_RUN_CYC: "run_cycles",
+    I_CPU_RESET:   "perform_cpu_reset",
+    I_CPU_FREERUN: "set_free_run",
+}
+
+# wire bytes (request, response) of an address pointer load
+# and of a word read, cost model of the read planner
+SEEK_COST = (5, 1)
+READ_COST = (1, 4)
+
+def plan_reads(words):
+    # groups sorted word addresses into runs read after one
+    # address pointer load each, returns [(start, number of words)]
+    # A gap is read through when the link finishes sooner than
+    # with a pointer load. The link is full duplex and the batch
+    # is streamed, so its time is set by the busier direction.
+    runs = []
+    tx = 0
+    rx = 0
+    for addr in words:
+        if runs:
+            start, n = runs[-1]
+            gap = (addr - start) // 4 - n
+            through = max(tx + gap*READ_COST[0], rx + gap*READ_COST[1])
+            seek = max(tx + SEEK_COST[0], rx + SEEK_COST[1])
+            if through <= seek:
+                runs[-1] = (start, n + gap + 1)
+                tx += (gap + 1) * READ_COST[0]
+                rx += (gap + 1) * READ_COST[1]
+                continue
+        
+        runs.append((addr, 1))
+        tx += SEEK_COST[0] + READ_COST[0]
+        rx += SEEK_COST[1] + READ_COST[1]
+    
+    return runs
+
 class Proto32:
-    def __init__(self, ser):
+    """
+    ser: serial port
+    window: device receive FIFO size in bytes, caps the amount of
+            requests sent but not yet answered (None -- unlimited)
+    """
+    def __init__(self, ser, window=None):
+        if window is not None and window < MAX_REQ_LEN:
+            raise ValueError(f"window must hold at least one request ({MAX_REQ_LEN} bytes)")
+        
         self.ser = ser
+        self.window = window
+        # Shadow of device memory, invalidated when the CPU runs
+        self.shadow = None
+        # Stats collecting wire statistics (None -- disabled)
+        self.stats = None
+        # Tuner adapting chunk/window of transfers (None -- fixed)
+        self.tuner = None
+        # model of the device address pointer after all
+        # requests sent or queued so far (None -- unknown)
+        self.ptr = None
+        # request buffer, reused between batches
+        self.bdata = bytearray()
         self.batch_reset()
         
     def batch_reset(self):
         self.bmode = False
-        self.bdata = bytes()
+        self.blen = 0
         self.brsp_len = 0
+        # cumulative request/response lengths at every request end
+        self.breq_ends = array("I")
+        self.brsp_ends = array("I")
+        # (response offset, expected bytes, func_name) to verify
+        self.bchecks = []
+        # address pointer model when the batch started
+        self.bptr = None
         
     def addr_format(self, addr):
         return f"{addr:08x}"
@@ -40,21 +127,37 @@ class Proto32:
         data = bytes(req)
         
         if self.bmode:
-            self.bdata += data
+            if rsp_check is not None:
+                self.bchecks.append((self.brsp_len, bytes(rsp_check), func_name))
+            
+            end = self.blen + len(data)
+            # overwrites preallocated space, extends past it
+            self.bdata[self.blen:end] = data
+            self.blen = end
             self.brsp_len += rsp_len
+            self.breq_ends.append(self.blen)
+            self.brsp_ends.append(self.brsp_len)
             return bytes()
         
+        if self.stats is not None:
+            t1 = time.perf_counter()
+        
         self.ser.write(data)
         echo = self.ser.read(rsp_len)
         
+        if self.stats is not None:
+            self.stats.record(data[:1], len(data), len(echo), time.perf_counter() - t1)
+        
         echo_len = len(echo)
         echo_arr = [d for d in echo]
         if echo_len != rsp_len:
             eprint(f"\ntimeout occured, received {echo_len} / {rsp_len} bytes: {echo_arr}")
             
+            self.invalidate_pointer()
             raise TimeoutError(f"{func_name}: timeout")
             
         if rsp_check is not None and echo != bytes(rsp_check):
+            self.invalidate_pointer()
             eprint(f"\n{func_name}: ack not matching")
             eprint(f"should be: {rsp_check}")
             eprint(f"is: {echo_arr}")
@@ -66,62 +169,313 @@ class Proto32:
     def request_with_ack(self, func_name, req):
         # pass to request, expecting 1 byte reply: OK (0x01)
         return self.request(func_name, req, 1, [OK])
+        
+    def request_bulk(self, func_name, req, req_len, rsp_len, rsp_check=None):
+        # queues many consecutive requests at once (batch mode only)
+        # req is the concatenation of req_len byte requests,
+        # each answered with rsp_len bytes (verified if rsp_check is given)
+        if not self.bmode:
+            raise ProtoError(f"{func_name}: bulk requests need batch mode")
+        
+        n = len(req) // req_len
+        if rsp_check is not None:
+            self.bchecks.append((self.brsp_len, bytes(rsp_check) * n, func_name))
+        
+        end = self.blen + len(req)
+        self.bdata[self.blen:end] = req
+        self.breq_ends.extend(range(self.blen + req_len, end + 1, req_len))
+        self.brsp_ends.extend(range(self.brsp_len + rsp_len, self.brsp_len + n*rsp_len + 1, rsp_len))
+        self.blen = end
+        self.brsp_len += n * rsp_len
     
-    def exchange(self, req, rsp_len):
-        # non-blocking exchange large amounts of data
-        ORIG_T  = self.ser.timeout
-        ORIG_WT = self.ser.write_timeout
-        self.ser.timeout = 0
-        self.ser.write_timeout = 0
-
-        written = 0
-        rsp = bytes()
-        while len(rsp) < rsp_len:
-            if written < len(req):
-                written += self.ser.write(req[written:])
-            rsp += self.ser.read(rsp_len - len(rsp))
-        
-        self.ser.timeout = ORIG_T
-        self.ser.write_timeout = ORIG_WT
-        return rsp
+    def exchange(self, req, rsp_len, req_ends=None, rsp_ends=None, deadline=None):
+        # exchange large amounts of data, see Exchange.exchange
+        # with window set, req_ends/rsp_ends (cumulative lengths
+        # at every request end) are used to find out how much of
+        # the sent data was already answered by the device
+        return exchange(self.ser, req, rsp_len, self.window, req_ends, rsp_ends, deadline)
     
-    def batch(self):
+    def batch(self, req_len=0):
         # Batch mode, requests accumulate in memory
         # execute and response collection in flush()
         # below protocol functions stay the same and
         # can be used in request generation as usual
         # (of course except their return values)
+        # req_len preallocates the request buffer if known
+        if not self.bmode:
+            self.bptr = self.pointer_state()
         self.bmode = True
+        if len(self.bdata) < req_len:
+            self.bdata.extend(bytes(req_len - len(self.bdata)))
+        
+    def batch_take(self):
+        # hands over the queued batch and leaves batch mode
+        # (request, response length, request ends, response ends, checks,
+        #  address pointer at batch start)
+        # the request buffer goes with the batch, a new one may be
+        # queued while it is in flight (see batch_recycle())
+        batch = (memoryview(self.bdata)[:self.blen], self.brsp_len, self.breq_ends, self.brsp_ends, self.bchecks, self.bptr)
+        self.bdata = bytearray()
+        self.batch_reset()
+        return batch
+        
+    def batch_recycle(self, batch):
+        # the request buffer of a finished batch is used by the
+        # next one (no other view of it may be left)
+        req = batch[0]
+        buf = req.obj
+        req.release()
+        if isinstance(buf, bytearray) and len(buf) > len(self.bdata):
+            self.bdata = buf
+        
+    def batch_address(self, batch, rsp_offset):
+        # replays the address pointer changes of the batch requests
+        # before the one answered at rsp_offset, returns the pointer
+        # value at that request (None if unknown)
+        req, rsp_len, req_ends, rsp_ends, checks, bptr = batch
+        k = bisect.bisect_right(rsp_ends, rsp_offset)
+        
+        addr = bptr
+        i = 0
+        for end in req_ends[:k]:
+            func = req[i]
+            if func == I_ADR_PTR_SET:
+                addr, = struct.unpack_from("<L", req, i+1)
+            elif func in (I_MEM_WR, I_MEM_RD) and addr is not None:
+                addr += 4
+            i = end
+        
+        return addr
         
-    def flush(self):
-        echo = self.exchange(self.bdata, self.brsp_len)
-        if len(echo) != self.brsp_len:
+    def batch_opcodes(self, batch, sent=None):
+        # opcode of every batch request
+        # (of requests started within <sent> bytes)
+        req, rsp_len, req_ends, rsp_ends, checks, bptr = batch
+        if sent is None:
+            sent = len(req)
+        yield from req[:1][:sent]
+        for end in req_ends[:-1]:
+            if end >= sent:
+                break
+            yield req[end]
+        
+    def batch_resync(self, batch, device):
+        # the batch skipped pointer loads assuming the pointer
+        # was as at its start, with <device> pointer being
+        # different, a load of the assumed one is put in front
+        # returns (batch, response bytes of the added load)
+        req, rsp_len, req_ends, rsp_ends, checks, bptr = batch
+        if bptr is None or bptr == device:
+            return batch, 0
+        
+        seek = bytes([I_ADR_PTR_SET]) + struct.pack("<L", bptr)
+        req_ends = array("I", [len(seek)]) + array("I", (end + len(seek) for end in req_ends))
+        rsp_ends = array("I", [1]) + array("I", (end + 1 for end in rsp_ends))
+        checks = [(0, bytes([OK]), "set_address_pointer")] + [(offset + 1, expected, func) for offset, expected, func in checks]
+        return (memoryview(seek + req), rsp_len + 1, req_ends, rsp_ends, checks, None), 1
+        
+    def batch_check(self, batch, echo):
+        # verifies the response of a batch, all acks at once
+        req, rsp_len, req_ends, rsp_ends, checks, bptr = batch
+        if len(echo) != rsp_len:
             eprint(f"\nbatch flush: response length not matching")
-            eprint(f"should be: {self.brsp_len}, is: {len(echo)}")
+            eprint(f"should be: {rsp_len}, is: {len(echo)}")
             raise ProtoError(f"batch flush: response length not matching")
-        self.batch_reset()
+        
+        for offset, expected, func_name in checks:
+            if echo[offset:offset+len(expected)] == expected:
+                continue
+            
+            # first failing byte
+            i = offset
+            while echo[i] == expected[i-offset]:
+                i += 1
+            
+            addr = self.batch_address(batch, i)
+            where = "?" if addr is None else f"${self.addr_format(addr)}"
+            eprint(f"\n{func_name}: ack not matching at {where}")
+            eprint(f"should be: {expected[i-offset]}")
+            eprint(f"is: {echo[i]}")
+            
+            raise ProtoError(f"{func_name}: ack not matching at {where}")
+        
+    def flush(self, deadline=None):
+        # deadline: seconds for the whole exchange (None -- unlimited)
+        # device inactivity is limited by the port timeout
+        batch = self.batch_take()
+        req, rsp_len, req_ends, rsp_ends, checks, bptr = batch
+        if self.stats is not None:
+            t1 = time.perf_counter()
+        
+        try:
+            echo = self.exchange(req, rsp_len, req_ends, rsp_ends, deadline)
+            
+            if self.stats is not None:
+                self.stats.record(self.batch_opcodes(batch), len(req), len(echo), time.perf_counter() - t1, flush=True)
+            self.batch_check(batch, echo)
+        except Exception as e:
+            # device may have stopped anywhere in the batch
+            self.invalidate_pointer()
+            if self.stats is not None and isinstance(e, ExchangeTimeout):
+                # a failed flush counts too, with what got through
+                self.stats.record(self.batch_opcodes(batch, e.written), e.written, e.received, time.perf_counter() - t1, flush=True, failed=True)
+            raise
+        
+        self.batch_recycle(batch)
         return echo
     
+    def transfer(self, queue):
+        # queues a batch with queue() and flushes it,
+        # returns (queue() return value, response)
+        # with tuner set the flush is measured, a failed one
+        # is queued again (after resync), queue() may use the
+        # backed-off tuner.chunk then
+        if self.tuner is None:
+            self.batch()
+            ret = queue()
+            return ret, self.flush()
+        
+        for attempt in range(RETRIES + 1):
+            try:
+                return self.transfer_once(queue)
+            except (TimeoutError, ProtoError):
+                if attempt == RETRIES:
+                    raise
+                self.retry()
+        
+    def transfer_image(self, image, queue, chunk, retries=RETRIES):
+        # transfers the image in batches of at most <chunk> bytes
+        # (of the current tuned size with tuner set), queue(piece)
+        # queues the batch of a piece,
+        # yields (piece, queue() return value, response)
+        # with tuner set a failed batch is split again at the
+        # backed-off size and its pieces are retried
+        for piece in self.pieces(image, chunk):
+            if self.tuner is None:
+                ret, rsp = self.transfer(lambda: queue(piece))
+                yield piece, ret, rsp
+                continue
+            
+            try:
+                ret, rsp = self.transfer_once(lambda: queue(piece))
+            except (TimeoutError, ProtoError):
+                if not retries:
+                    raise
+                self.retry()
+                yield from self.transfer_image(piece, queue, chunk, retries - 1)
+                continue
+            
+            yield piece, ret, rsp
+        
+    def transfer_once(self, queue):
+        # one measured attempt of transfer() (tuner set)
+        self.batch()
+        ret = queue()
+        nbytes = self.blen + self.brsp_len
+        
+        window = self.window
+        self.window = self.tuned_window()
+        
+        t1 = time.perf_counter()
+        try:
+            rsp = self.flush()
+        except (TimeoutError, ProtoError) as e:
+            self.tuner.failed(time.perf_counter() - t1, isinstance(e, TimeoutError))
+            raise
+        finally:
+            self.window = window
+        
+        self.tuner.done(nbytes, time.perf_counter() - t1)
+        return ret, rsp
+        
+    def tuned_window(self):
+        # in-flight limit of a tuned batch, the tuner's one
+        # but never above a given window
+        if self.tuner.window is None:
+            return self.window
+        if self.window is None:
+            return self.tuner.window
+        return min(self.window, self.tuner.window)
+        
+    def retry(self):
+        # gets the device ready for repeating a failed batch
+        eprint(f"retrying batch (chunk {self.tuner.chunk}, window {self.tuned_window() or 'unlimited'})")
+        # a desynced device may have taken data bytes for
+        # any request (writes elsewhere, run, reset),
+        # memory outside the batch is no longer known
+        self.cpu_may_run()
+        self.resync()
+        
+    def resync(self):
+        # after a failed batch the device may be inside a request,
+        # filler bytes (pointer reads) complete it, all answers
+        # are dropped until the line is quiet
+        # (the pointer model is loaded from the device again)
+        self.ser.write(bytes([I_ADR_PTR_GET]) * (MAX_REQ_LEN - 1))
+        
+        timeout = self.ser.timeout
+        self.ser.timeout = DRAIN_IDLE
+        try:
+            while self.ser.read(0x1000):
+                pass
+        finally:
+            self.ser.timeout = timeout
+        
+        # device answers again
+        self.get_address_pointer()
+        
+    def pieces(self, image, chunk):
+        # splits the image into pieces of at most <chunk> bytes
+        # (of the current tuned size with tuner set),
+        # small segments share a piece
+        if self.tuner is None:
+            return image.pieces(chunk)
+        return image.pieces(lambda: self.tuner.chunk)
+        
+    # address pointer model
+    def invalidate_pointer(self):
+        self.ptr = None
+        
+    def pointer_state(self):
+        # model as stored with batches
+        return self.ptr
+        
+    def advance_pointer(self, n):
+        # pointer moved by n bytes (reads/writes)
+        if self.ptr is not None:
+            self.ptr = (self.ptr + n) & 0xFFFFFFFF
+    
     # protocol functions
     def set_address_pointer(self, addr):
+        # skipped when the pointer model is already there
+        if self.ptr == addr:
+            return
+        if self.stats is not None:
+            self.stats.seeks += 1
+        self.ptr = addr
         self.request_with_ack("set_address_pointer", bytes([I_ADR_PTR_SET]) + struct.pack("<L", addr))
         
     def get_address_pointer(self):
         addr = self.request("get_address_pointer", [I_ADR_PTR_GET], 4)
-        return struct.unpack("<L", addr)
+        self.ptr, = struct.unpack("<L", addr)
+        return self.ptr
         
     def write_memory_4_byte(self, b):
+        self.advance_pointer(4)
         self.request_with_ack("write_memory_4_byte", [I_MEM_WR]+b)
         
     def read_memory_4_byte(self):
+        self.advance_pointer(4)
         data = self.request("read_memory_4_byte", [I_MEM_RD], 4)
         return data
         
     def run_cycles(self, cycles):
+        self.cpu_may_run()
         self.request_with_ack("run_cycles", [I_CPU_RUN_CYC, cycles])
         
     def pulse_cpu_reset(self):
         # only pulls reset down for 1 cycle
+        self.cpu_may_run()
         self.request_with_ack("perform_cpu_reset", [I_CPU_RESET])
 
     def perform_cpu_reset(self):
@@ -131,65 +485,190 @@ class Proto32:
         self.run_cycles(8)
         
     def set_free_run(self, enabled):
+        self.cpu_may_run()
         self.request_with_ack("set_free_run", [I_CPU_FREERUN, enabled])
     
     
     # public interface functions
-    def write_memory_dict(self, data_dict):
+    def cpu_may_run(self):
+        # memory may change behind our back,
+        # shadow copy is no longer valid
+        # (nor is the address pointer model)
+        if self.shadow is not None:
+            self.shadow.invalidate()
+        self.invalidate_pointer()
         
-        data_dict32 = defaultdict(lambda: [0]*4)
-        for adr, val in data_dict.items():
-            adr32 = adr & ~0x3
-            data_dict32[adr32][adr%4] = val
+    def write_memory_words(self, data):
+        # queues consecutive 4 byte writes of data (batch mode only)
+        # data length must be a multiple of 4
+        n = len(data) // 4
+        req = bytearray(5 * n)
+        req[0::5] = bytes([I_MEM_WR]) * n
+        for k in range(4):
+            req[k+1::5] = data[k::4]
+        self.advance_pointer(4 * n)
+        self.request_bulk("write_memory_4_byte", req, 5, 1, [OK])
         
-        self.batch()
+    def read_memory_words(self, n):
+        # queues n consecutive 4 byte reads (batch mode only)
+        self.advance_pointer(4 * n)
+        self.request_bulk("read_memory_4_byte", bytes([I_MEM_RD]) * n, 1, 4)
         
-        lastaddr = -1000
-        for addr in sorted(data_dict32.keys()):
-            val = data_dict32[addr]
-            if lastaddr+4 != addr:
-                print(f"loading adr_ptr with ${addr:08x}")
-                self.set_address_pointer(addr)
-            
-            # print(f"${addr:08x}  ${val}")
-            self.write_memory_4_byte(val)
-            
-            lastaddr = addr
-            
-        self.flush()
+    def queue_write_memory(self, image):
+        # queues requests writing image (batch mode)
+        # partially covered words are padded with zeros
+        # (see fill_partial_words())
+        image = image.aligned(4)
         
-    def read_memory_dict(self, addresses):
-        # zero 4 least significant (and with negated 32'b11)
-        # dict for uniqueness, make sorted list
-        addresses32 = {x&~0x3 for x in addresses}
-        addresses32 = sorted(addresses32)
+        # every word is 5 bytes, address pointer loads extend the buffer
+        self.batch(self.blen + len(image) // 4 * 5)
         
-        rsp = bytes()
-        self.batch()
+        for addr, data in image.segments():
+            self.set_address_pointer(addr)
+            self.write_memory_words(data)
         
-        lastaddr = -1000
-        for addr in addresses32:
+    def queue_read_image(self, image):
+        # queues reads of all words covering segments of image (batch mode)
+        # returns [(start, length, response offset)]
+        spans = []
+        for addr, data in image.segments():
+            spans.append((addr, len(data), self.queue_read_range(addr, len(data))))
+        
+        return spans
+        
+    def queue_read_range(self, addr, n):
+        # queues reads of all words covering n bytes at addr (batch mode)
+        # returns response offset of the first byte
+        astart = addr & ~0x3
+        aend = (addr + n + 3) & ~0x3
+        self.set_address_pointer(astart)
+        offset = self.brsp_len + addr - astart
+        self.read_memory_words((aend - astart) // 4)
+        return offset
+        
+    def queue_read_memory(self, addresses):
+        # queues reads of all words covering addresses (batch mode)
+        # address pointer loads stay inside the batch, small gaps
+        # are read through (see plan_reads())
+        # returns {addr: offset of its byte in the response}
+        words = sorted({x&~0x3 for x in addresses})
+        
+        word_offsets = {}
+        i = 0
+        for start, n in plan_reads(words):
+            self.set_address_pointer(start)
+            offset = self.brsp_len
+            self.read_memory_words(n)
             
-            if lastaddr+4 != addr:
-                rsp += self.flush()
+            end = start + 4*n
+            while i < len(words) and words[i] < end:
+                word_offsets[words[i]] = offset + words[i] - start
+                i += 1
+        
+        return {addr: word_offsets[addr&~0x3] + addr%4 for addr in addresses}
+        
+    def queue_write_verify(self, image):
+        # queues writes of image, each segment followed by
+        # its read-back (batch mode), returns spans like queue_read_image
+        image = image.aligned(4)
+        
+        # write and read of a word are 6 bytes
+        self.batch(self.blen + len(image) // 4 * 6)
+        
+        spans = []
+        for addr, data in image.segments():
+            piece = MemoryImage.from_buffer(addr, data)
+            self.queue_write_memory(piece)
+            spans += self.queue_read_image(piece)
+        
+        return spans
+        
+    def fill_partial_words(self, image):
+        # image extended to whole words, device bytes next to
+        # the image in partly covered words are read first (one batch),
+        # so writing the words back leaves them unchanged
+        words = image.partial_words(4)
+        if not words:
+            return image
+        
+        known = self.read_memory_dict([w + k for w in words for k in range(4)])
+        return image.aligned(4, known=known)
+        
+    def write_memory_image(self, image, chunk=CHUNK):
+        # streams the image in batches of at most <chunk> bytes,
+        # memory use doesn't depend on the image size
+        # bytes next to the image are kept (see fill_partial_words())
+        starts = {addr & ~0x3 for addr in image.starts}
+        image = self.fill_partial_words(image)
+        def queue(piece):
+            for addr in sorted(starts.intersection(piece.starts)):
                 print(f"loading adr_ptr with ${addr:08x}")
-                self.set_address_pointer(addr)
-                self.batch()
-            
-            ret = self.read_memory_4_byte()
-            # rsp += ret
-            
-            lastaddr = addr
+            self.queue_write_memory(piece)
+        
+        for _ in self.transfer_image(image, queue, chunk):
+            pass
+        
+    def write_memory_dict(self, data_dict):
+        self.write_memory_image(as_image(data_dict))
+        
+    def read_memory_image(self, image):
+        # reads memory covered by image, returns new image
+        spans, rsp = self.transfer(lambda: self.queue_read_image(image))
+        return MemoryImage.from_spans(spans, rsp)
+        
+    def read_memory_stream(self, addr, n, chunk=CHUNK):
+        # reads n bytes at addr in batches of at most <chunk> bytes
+        # (of the current tuned size with tuner set),
+        # yields (start, memoryview) pieces in address order,
+        # memory use doesn't depend on n
+        end = addr + n
+        def queue():
+            # sized when queued, a retry uses the backed-off chunk
+            # (pieces after the first one start word aligned)
+            size = min((chunk if self.tuner is None else self.tuner.chunk) - addr % 4, end - addr)
+            return self.queue_read_range(addr, size), size
+        
+        while addr < end:
+            (offset, size), rsp = self.transfer(queue)
             
-        rsp += self.flush()
-        print("read rsp len:", len(rsp))
+            yield addr, rsp[offset:offset+size]
+            addr += size
+        
+    def verify_memory_image(self, image, chunk=CHUNK):
+        # reads back the image in batches of at most <chunk> bytes
+        # returns image of device memory differing from image (empty if ok)
+        diff = MemoryImage()
+        for piece, spans, rsp in self.transfer_image(image, self.queue_read_image, chunk):
+            diff.overlay(piece.differing(spans, rsp))
         
-        mem_dict = {}
-        for addr, val in zip(addresses, rsp):
-            mem_dict[addr] = val
+        return diff
         
-        return mem_dict
+    def write_verify_image(self, image, chunk=CHUNK):
+        # writes and reads back the image in one pass, every batch
+        # carries writes and read-backs of at most <chunk> bytes
+        # returns image of device memory differing from image (empty if ok)
+        # bytes next to the image are kept (see fill_partial_words())
+        starts = {addr & ~0x3 for addr in image.starts}
+        image = self.fill_partial_words(image)
+        def queue(piece):
+            for addr in sorted(starts.intersection(piece.starts)):
+                print(f"loading adr_ptr with ${addr:08x}")
+            return self.queue_write_verify(piece)
+        
+        diff = MemoryImage()
+        for piece, spans, rsp in self.transfer_image(image, queue, chunk):
+            diff.overlay(piece.differing(spans, rsp))
+        
+        return diff
+        
+    def read_memory_dict(self, addresses):
+        # any addresses, read in one batch
+        offsets, rsp = self.transfer(lambda: self.queue_read_memory(addresses))
+        return {addr: rsp[i] for addr, i in offsets.items()}
     
+    def print_stats(self):
+        print(self.stats.report(OPCODES))
+        
     def print_status(self):
         raise NotImplementedError()
         
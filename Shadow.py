@@ -0,0 +1,37 @@
+import os
+
+from MemoryImage import MemoryImage
+from Cache import cache_path, write_atomic
+
+class Shadow:
+    """
+    Persisted copy of device memory as last written and verified.
+    One shadow per port and board, it's stored in ~/.cache/debug_uart/shadow
+    Anything that lets the CPU run (or the user) invalidates it,
+    as memory may have been changed behind our back.
+
+    port: serial port path
+    board: board name, for multiple boards used on one port
+    """
+    def __init__(self, port, board=None):
+        self.path = cache_path("shadow", port, board or "")
+
+    def load(self):
+        # image of known device memory (empty if nothing known)
+        try:
+            with open(self.path, "rb") as f:
+                return MemoryImage.load(f.read())
+        except (OSError, ValueError):
+            return MemoryImage()
+
+    def update(self, image):
+        # image was written and verified
+        known = self.load()
+        known.overlay(image)
+        write_atomic(self.path, known.dump())
+
+    def invalidate(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+import os
+import tty
+import time
+import random
+import select
+import argparse
+
+# idle wait of the simulation loop
+TICK = 0.0005
+
+class Dbgu:
+    """
+    8bit debug unit (see docs/instruction set.ods)
+    every request is 2 bytes, every response is 2 bytes
+    The CPU itself isn't simulated: registers keep their values,
+    a reset loads PC from the vector at FFFC on the next cycle.
+    """
+    def __init__(self):
+        self.mem = bytearray(0x10000)
+        self.ptr = 0
+        self.regs = {"A": 0, "S": 0, "X": 0, "Y": 0, "IR": 0, "P": 0, "PC": 0}
+        self.cycles = 0
+        self.reset_pending = False
+        self.freerun = False
+
+    def request_len(self, op):
+        return 2
+
+    def run(self, cycles):
+        if self.reset_pending:
+            self.regs["PC"] = self.mem[0xFFFC] | self.mem[0xFFFD] << 8
+            self.reset_pending = False
+        self.cycles += cycles
+
+    def handle(self, req):
+        op, arg = req
+        r = self.regs
+        if op == 0x01:
+            self.ptr = (self.ptr & 0xFF00) | arg
+        elif op == 0x02:
+            self.ptr = (self.ptr & 0x00FF) | arg << 8
+        elif op == 0x03:
+            return bytes([self.ptr & 0xFF, self.ptr >> 8])
+        elif op == 0x04:
+            self.mem[self.ptr] = arg
+            self.ptr = (self.ptr + 1) & 0xFFFF
+        elif op == 0x05:
+            rsp = bytes([self.mem[self.ptr], self.mem[(self.ptr + 1) & 0xFFFF]])
+            self.ptr = (self.ptr + 2) & 0xFFFF
+            return rsp
+        elif op == 0x10:
+            return bytes([r["A"], r["S"]])
+        elif op == 0x11:
+            return bytes([r["X"], r["Y"]])
+        elif op == 0x12:
+            return bytes([r["IR"], r["P"]])
+        elif op == 0x13:
+            return bytes([r["PC"] & 0xFF, r["PC"] >> 8])
+        elif op == 0x20:
+            self.run(arg)
+        elif op == 0x21:
+            self.reset_pending = True
+        elif op == 0x22:
+            self.freerun = bool(arg)
+
+        # everything else is echoed
+        return bytes(req)
+
+
+class Dbgu32:
+    """
+    32bit debug unit (see docs/instruction set 32.ods)
+    memory is sparse (pages allocated on write, zeros elsewhere)
+    """
+    OK = b"\x01"
+    REQ_LEN = {0x01: 5, 0x03: 1, 0x04: 5, 0x05: 1, 0x20: 2, 0x21: 1, 0x22: 2}
+    PAGE = 0x1000
+
+    def __init__(self):
+        self.pages = {}
+        self.ptr = 0
+        self.cycles = 0
+        self.reset_pending = False
+        self.freerun = False
+
+    def request_len(self, op):
+        # unknown opcodes are skipped byte by byte
+        return self.REQ_LEN.get(op, 1)
+
+    def read_word(self, addr):
+        page = self.pages.get(addr // self.PAGE)
+        if page is None:
+            return bytes(4)
+        offset = addr % self.PAGE
+        return bytes(page[offset:offset+4])
+
+    def write_word(self, addr, data):
+        page = self.pages.setdefault(addr // self.PAGE, bytearray(self.PAGE))
+        offset = addr % self.PAGE
+        page[offset:offset+4] = data
+
+    def handle(self, req):
+        op = req[0]
+        if op == 0x01:
+            self.ptr = int.from_bytes(req[1:5], "little")
+        elif op == 0x03:
+            return self.ptr.to_bytes(4, "little")
+        elif op == 0x04:
+            # word accesses ignore the low address bits
+            self.write_word(self.ptr & ~0x3, req[1:5])
+            self.ptr = (self.ptr + 4) & 0xFFFFFFFF
+        elif op == 0x05:
+            rsp = self.read_word(self.ptr & ~0x3)
+            self.ptr = (self.ptr + 4) & 0xFFFFFFFF
+            return rsp
+        elif op == 0x20:
+            self.reset_pending = False
+            self.cycles += req[1]
+        elif op == 0x21:
+            self.reset_pending = True
+        elif op == 0x22:
+            self.freerun = bool(req[1])
+        else:
+            return bytes()
+
+        return self.OK
+
+
+class Simulator:
+    """
+    Debug unit on a pseudo-terminal, open slave_path() like a serial port
+    (baud set by the host is ignored, throttling uses <baud>).
+
+    dev: Dbgu/Dbgu32
+    baud: simulated line speed (10 bits per byte), None -- unlimited
+    fifo: receive FIFO depth in bytes, bytes arriving when it's
+          full are lost (like on the FPGA), None -- unlimited
+    tx_fifo: responses are buffered up to this many bytes, the device
+             stops processing requests when it's full (throttled only)
+    drop: probability of losing a received byte
+    corrupt: probability of flipping a bit of a sent byte
+    seed: random seed for faults
+    """
+    def __init__(self, dev, baud=None, fifo=None, tx_fifo=16, drop=0, corrupt=0, seed=None):
+        self.dev = dev
+        self.baud = baud
+        self.fifo = fifo
+        self.tx_fifo = tx_fifo
+        self.drop = drop
+        self.corrupt = corrupt
+        self.random = random.Random(seed)
+
+        # statistics
+        self.received = 0
+        self.sent = 0
+        self.overflows = 0
+        self.dropped = 0
+        self.corrupted = 0
+
+        self.line = bytearray()   # sent by the host, not yet on the device
+        self.rx = bytearray()     # device receive FIFO
+        self.tx = bytearray()     # device responses not yet on the line
+        self.out = bytearray()    # on the line, not yet taken by the pty
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+
+    def slave_path(self):
+        return os.ttyname(self.slave)
+
+    def receive(self, data):
+        # bytes off the line into the receive FIFO
+        self.received += len(data)
+        if not self.drop and (self.fifo is None or len(self.rx) + len(data) <= self.fifo):
+            self.rx += data
+            return
+
+        for b in data:
+            if self.drop and self.random.random() < self.drop:
+                self.dropped += 1
+            elif self.fifo is not None and len(self.rx) >= self.fifo:
+                self.overflows += 1
+            else:
+                self.rx.append(b)
+
+    def ready(self):
+        # complete request in the receive FIFO
+        return bool(self.rx) and len(self.rx) >= self.dev.request_len(self.rx[0])
+
+    def process(self, limit):
+        # handles requests while responses fit in <limit> bytes
+        while self.ready() and len(self.tx) < limit:
+            k = self.dev.request_len(self.rx[0])
+            self.tx += self.dev.handle(bytes(self.rx[:k]))
+            del self.rx[:k]
+
+    def send(self, data):
+        # bytes off the line to the host
+        if self.corrupt:
+            data = bytearray(data)
+            for i in range(len(data)):
+                if self.random.random() < self.corrupt:
+                    data[i] ^= 1 << self.random.randrange(8)
+                    self.corrupted += 1
+
+        self.sent += len(data)
+        self.out += data
+
+    def step(self, budget_rx, budget_tx):
+        # moves as many bytes as the line carries in this step,
+        # returns unused budgets
+        if self.baud is None:
+            self.receive(self.line)
+            self.line.clear()
+            self.process(float("inf"))
+            self.send(self.tx)
+            self.tx.clear()
+            return 0.0, 0.0
+
+        # byte by byte, so the FIFO fills like on the real line
+        while True:
+            moved = False
+            if budget_rx >= 1 and self.line:
+                self.receive(self.line[:1])
+                del self.line[:1]
+                budget_rx -= 1
+                moved = True
+
+            self.process(self.tx_fifo)
+
+            if budget_tx >= 1 and self.tx:
+                self.send(self.tx[:1])
+                del self.tx[:1]
+                budget_tx -= 1
+                moved = True
+
+            if not moved:
+                return budget_rx, budget_tx
+
+    def serve(self):
+        # bytes the line can carry now
+        budget_rx = 0.0
+        budget_tx = 0.0
+        last = time.monotonic()
+
+        while True:
+            # an idle line doesn't save up bandwidth
+            busy_rx = bool(self.line)
+            busy_tx = bool(self.tx) or self.ready()
+
+            wait = TICK if busy_rx or busy_tx or self.out else None
+            select.select([self.master], [], [], wait)
+            try:
+                self.line += os.read(self.master, 0x10000)
+            except BlockingIOError:
+                pass
+
+            now = time.monotonic()
+            step = (now - last) * (self.baud or 0) / 10
+            last = now
+            budget_rx = budget_rx + step if busy_rx else 0.0
+            budget_tx = budget_tx + step if busy_tx else 0.0
+
+            budget_rx, budget_tx = self.step(budget_rx, budget_tx)
+
+            if self.out:
+                try:
+                    n = os.write(self.master, self.out)
+                except BlockingIOError:
+                    n = 0
+                del self.out[:n]
+
+    def stats(self):
+        return (f"received {self.received}, sent {self.sent}, overflows {self.overflows}, "
+                f"dropped {self.dropped}, corrupted {self.corrupted}")
+
+
+def get_args():
+    p = argparse.ArgumentParser(description="Simulate the debug unit on a pseudo-terminal")
+    p.add_argument("--d32", help="simulate dbgu32", required=False, default=False, action='store_true')
+    p.add_argument("-b", "--baudrate", help="simulated line speed (default: unlimited)", required=False, default=None, metavar="BAUD", type=int)
+    p.add_argument("-f", "--fifo", help="receive FIFO depth [bytes], overflowing bytes are lost (default: unlimited)", required=False, default=None, metavar="BYTES", type=int)
+    p.add_argument("--drop", help="probability of losing a received byte", required=False, default=0, metavar="P", type=float)
+    p.add_argument("--corrupt", help="probability of flipping a bit of a sent byte", required=False, default=0, metavar="P", type=float)
+    p.add_argument("--seed", help="random seed for faults", required=False, default=None, type=int)
+    p.add_argument("-l", "--link", help="symlink to create for the pty (eg. /tmp/ttySIM)", required=False, default=None)
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    dev = Dbgu32() if args.d32 else Dbgu()
+    sim = Simulator(dev, args.baudrate, args.fifo, drop=args.drop, corrupt=args.corrupt, seed=args.seed)
+
+    path = sim.slave_path()
+    if args.link:
+        if os.path.islink(args.link):
+            os.remove(args.link)
+        os.symlink(path, args.link)
+        path = args.link
+
+    print(f"simulating {'dbgu32' if args.d32 else 'dbgu'} on {path}", flush=True)
+    try:
+        sim.serve()
+    except KeyboardInterrupt:
+        print()
+        print(sim.stats())
+    finally:
+        if args.link:
+            os.remove(args.link)
@@ -0,0 +1,67 @@
+from collections import Counter
+
+class Stats:
+    """
+    Wire-level statistics of a protocol object, collected
+    when set as its <stats> attribute (None -- disabled, no cost)
+
+    requests: opcode -> number of requests
+    sent, received: bytes on the wire
+    exchanges: synchronous requests + batch flushes
+    seeks: address pointer loads (counted by the protocol, one
+           per load however many requests it takes)
+    flushes: batch flushes
+    failed: batch flushes which timed out (counted with the
+            requests and bytes that got through)
+    latency: log2 bucket of exchange time in microseconds -> count
+             (bucket k holds times in [2^(k-1), 2^k) us)
+    """
+    def __init__(self):
+        self.requests = Counter()
+        self.sent = 0
+        self.received = 0
+        self.exchanges = 0
+        self.flushes = 0
+        self.failed = 0
+        self.seeks = 0
+        self.seconds = 0.0
+        self.latency = Counter()
+
+    def record(self, opcodes, sent, received, seconds, flush=False, failed=False):
+        # one exchange of requests with <opcodes> (iterable)
+        self.requests.update(opcodes)
+        self.sent += sent
+        self.received += received
+        self.exchanges += 1
+        self.flushes += flush
+        self.failed += failed
+        self.seconds += seconds
+        self.latency[max(0, int(seconds * 1e6)).bit_length()] += 1
+
+    def report(self, names=None):
+        # human readable summary
+        # names: opcode -> name
+        names = names or {}
+        lines = []
+        lines.append(f"exchanges: {self.exchanges} ({self.flushes} batch flushes, {self.failed} failed), {self.seconds:.3f}s on the wire")
+        lines.append(f"bytes: sent {self.sent}, received {self.received}")
+        lines.append(f"address pointer loads: {self.seeks}")
+
+        lines.append("requests:")
+        for op, count in sorted(self.requests.items()):
+            lines.append(f"  {op:02x} {names.get(op, '?'):26} {count}")
+
+        lines.append("exchange latency:")
+        for bucket, count in sorted(self.latency.items()):
+            low = 1 << bucket >> 1
+            lines.append(f"  {format_us(low):>8} - {format_us(1 << bucket):<8} {count}")
+
+        return "\n".join(lines)
+
+
+def format_us(us):
+    if us >= 1000000:
+        return f"{us / 1000000:g}s"
+    if us >= 1000:
+        return f"{us / 1000:g}ms"
+    return f"{us}us"
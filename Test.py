@@ -1,4 +1,129 @@
+import os
+import queue
+import hashlib
+import threading
+import tempfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from IHex import load_ihex
+from ProtoError import ProtoError
+from Expr import compile_expr
+from Cache import cache_dir
+
+# tests print from several board threads, keeps lines whole
+print_lock = threading.Lock()
+
+def tprint(*args, **kwargs):
+    with print_lock:
+        print(*args, **kwargs)
+
+
+VASM = ["vasm6502_oldstyle", "-dotdir", "-esc", "-wdc02", "-Fihex"]
+
+class AssemblerError(Exception):
+    def __init__(self, stderr):
+        super().__init__("vasm error")
+        self.stderr = stderr
+
+
+"""
+Assemble code, returns path of its Intel Hex file
+Results are cached in ~/.cache/debug_uart/asm by hash of
+the assembler command and code, so unchanged tests aren't
+assembled again. Safe to run in parallel.
+"""
+def assemble(code):
+    key = hashlib.sha1("\0".join(VASM + [code]).encode()).hexdigest()
+    pgm = os.path.join(cache_dir("asm"), f"{key}.hex")
+    if os.path.exists(pgm):
+        return pgm
+
+    # own files per call, finished hex is moved in place
+    with tempfile.TemporaryDirectory(dir=cache_dir("asm")) as tmp:
+        asm = os.path.join(tmp, "test.s")
+        out = os.path.join(tmp, "test.hex")
+        with open(asm, "w") as f:
+            f.write(code)
+
+        p = subprocess.run(VASM + [asm, "-o", out], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            raise AssemblerError(p.stderr.decode())
+
+        os.replace(out, pgm)
+
+    return pgm
+
+
+"""
+Compile all tests, assembler runs in parallel
+(threads only wait for vasm processes)
+"""
+def compile_all(tests, jobs=None):
+    with ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+        futures = [pool.submit(assemble, test.code) for test in tests]
+
+    for test, future in zip(tests, futures):
+        try:
+            test.pgm = future.result()
+        except AssemblerError as e:
+            tprint(f"vasm errored in test {test.name}")
+            tprint(e.stderr)
+            raise ValueError("vasm error")
+
+"""
+Run tests spread over identical boards
+Every board has its worker thread taking the next test
+from a shared queue, so a slow test only holds up its board.
+A board that errored is not used anymore.
+    prots: {board name: Proto}
+returns [(test, board name)] of failed tests
+(board None -- test didn't run, no boards left)
+"""
+def run_sharded(tests, prots):
+    todo = queue.SimpleQueue()
+    for test in tests:
+        todo.put(test)
+
+    failed = []
+
+    def worker(name, prot):
+        while True:
+            try:
+                test = todo.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                test.upload(prot)
+                test.run(prot)
+                r = test.verify(prot)
+            except (ProtoError, OSError) as e:
+                # board (or its port) failed, it takes no more tests
+                # (timeouts and serial errors are OSErrors)
+                tprint(f"error in test {test.name} on {name}: {e}")
+                failed.append((test, name))
+                return
+            except Exception as e:
+                # broken test, the board is fine
+                tprint(f"error in test {test.name} on {name}: {e!r}")
+                failed.append((test, name))
+                continue
+
+            if r != 0:
+                failed.append((test, name))
+
+    workers = [threading.Thread(target=worker, args=item) for item in prots.items()]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    while not todo.empty():
+        failed.append((todo.get(), None))
+
+    return failed
+
 
 # all numbers hex
 class Test:
@@ -17,59 +142,38 @@ class Test:
         for test in tests:
             what, should_be = test.split("=")
             should_be = int(should_be, 16)
+            # fails early on typos, get() reuses the compiled expression
+            compile_expr(what)
             self.tests[what] = should_be
         
-        self.asm = ".tmp.s"
-        self.pgm = ".tmp.hex"
+        # hex file, set by compile()
+        self.pgm = None
 
     def compile(self):
-        with open(self.asm, "w") as f:
-            f.write(self.code)
-        
-        p = subprocess.run([
-            "vasm6502_oldstyle", "-dotdir", "-esc", "-wdc02",
-            "-Fihex", self.asm,
-            "-o", self.pgm
-        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        if p.returncode != 0:
-            print(f"vasm errored")
-            print(p.stderr.decode())
+        try:
+            self.pgm = assemble(self.code)
+        except AssemblerError as e:
+            tprint(f"vasm errored in test {self.name}")
+            tprint(e.stderr)
             raise ValueError("vasm error")
     
-    def upload(self, serial_path, serial_baud):
-        p = subprocess.run([
-            "./debug.py",
-            "-p", serial_path, "-b", str(serial_baud),
-            "write",
-            "-i", self.pgm,
-            "-v"
-        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def upload(self, prot):
+        # program and reset vector, written and verified in one batch
+        image = load_ihex(self.pgm)
+        image.add(0xFFFC, bytes([0x00, 0x80]))
         
-        if p.returncode == 0:
-            # write reset vector
-            p = subprocess.run([
-                "./debug.py",
-                "-p", serial_path, "-b", str(serial_baud),
-                "write",
-                "-o", "FFFC",
-                "--mem", "00", "80",
-                "-v"
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            
-            if p.returncode == 0:
-                return
+        prot.batch()
+        spans = prot.queue_write_verify(image)
+        diff = image.differing(spans, prot.flush())
         
-        print(f"debug.py errored")
-        print(p.stderr.decode())
-        subprocess.run([
-            "./debug.py",
-            "-p", serial_path, "-b", str(serial_baud),
-            "read",
-            "-o", "8000",
-            "-n", "32"
-        ])
-        raise ValueError("debug.py error")
+        if len(diff):
+            addr = diff.starts[0]
+            tprint("upload errored")
+            tprint(f"verify error: first error at ${addr:04x}: should be ${image[addr]:02x}, is ${diff[addr]:02x}")
+            for start, data in diff.segments():
+                tprint(f"  ${start:04x} - ${start+len(data)-1:04x}")
+            # memory of the board, not the test
+            raise ProtoError("upload error")
 
     def run(self, prot):
         prot.perform_cpu_reset()
@@ -85,14 +189,16 @@ class Test:
     def verify(self, prot):
         ok = True
         
+        # all values in one batch
+        values = prot.snapshot(self.tests)
         for what, should_be in self.tests.items():
-            val = prot.get(what)
+            val = values[what]
             if val != should_be:
-                print(f"error in test {self.name}: {what} should be ${should_be:02x}, is ${val:02x}")
+                tprint(f"error in test {self.name}: {what} should be ${should_be:02x}, is ${val:02x}")
                 ok = False
                 
         if not ok:
             return -1
         
-        print(f"test {self.name:20} OK.")
+        tprint(f"test {self.name:20} OK.")
         return 0
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import struct
+import argparse
+from collections import deque
+
+from ProtoError import ProtoError
+
+# trace file: magic, then records (direction, ns since start, length, data)
+TRACE_MAGIC = b"DBGT\x01"
+TRACE_RECORD = struct.Struct("<cQI")
+
+TX = b"T"
+RX = b"R"
+
+class Trace:
+    """
+    Recorder of wire traffic, every chunk written to or read from
+    the port is kept with its monotonic timestamp
+
+    ring: keep only the last <ring> chunks (None -- everything)
+    """
+    def __init__(self, ring=None):
+        self.start = time.monotonic_ns()
+        self.records = deque(maxlen=ring)
+
+    def record(self, direction, data):
+        self.records.append((direction, time.monotonic_ns() - self.start, bytes(data)))
+
+    def dump(self):
+        parts = [TRACE_MAGIC]
+        for direction, t, data in self.records:
+            parts.append(TRACE_RECORD.pack(direction, t, len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.dump())
+
+
+def load_trace(path):
+    # [(direction, ns since start, data)]
+    with open(path, "rb") as f:
+        buf = f.read()
+
+    if not buf.startswith(TRACE_MAGIC):
+        raise ValueError(f"{path}: not a trace file")
+
+    records = []
+    offset = len(TRACE_MAGIC)
+    while offset < len(buf):
+        direction, t, length = TRACE_RECORD.unpack_from(buf, offset)
+        offset += TRACE_RECORD.size
+        records.append((direction, t, buf[offset:offset+length]))
+        offset += length
+
+    return records
+
+
+class TracePort:
+    """
+    Port wrapper recording all traffic into a Trace,
+    the rest is passed to the wrapped port
+    (one append per chunk, the exchange loop isn't slowed down)
+    """
+    def __init__(self, ser, trace):
+        self.ser = ser
+        self.trace = trace
+
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.ser.timeout = value
+
+    @property
+    def write_timeout(self):
+        return self.ser.write_timeout
+
+    @write_timeout.setter
+    def write_timeout(self, value):
+        self.ser.write_timeout = value
+
+    def fileno(self):
+        return self.ser.fileno()
+
+    def write(self, data):
+        n = self.ser.write(data)
+        if n:
+            self.trace.record(TX, memoryview(data)[:n])
+        return n
+
+    def read(self, n):
+        data = self.ser.read(n)
+        if data:
+            self.trace.record(RX, data)
+        return data
+
+    def readinto(self, b):
+        n = self.ser.readinto(b)
+        if n:
+            self.trace.record(RX, memoryview(b)[:n])
+        return n
+
+    def close(self):
+        self.ser.close()
+
+
+class ReplayPort:
+    """
+    Fake port answering with the responses of a trace.
+    A response chunk is available once all requests sent before
+    it in the trace were written, so the protocol sees the same
+    order of events. Requests have to match the trace.
+
+    records: trace records (see load_trace())
+    realtime: also wait for the recorded time of every response
+    """
+    def __init__(self, records, realtime=False):
+        self.tx = b"".join(data for direction, t, data in records if direction == TX)
+        # (TX bytes needed, ns since start, data) of every response chunk
+        self.rx = deque()
+        sent = 0
+        for direction, t, data in records:
+            if direction == TX:
+                sent += len(data)
+            else:
+                self.rx.append((sent, t, data))
+
+        self.realtime = realtime
+        self.start = time.monotonic_ns()
+        self.written = 0
+        self.pending = bytearray()
+        self.timeout = 1
+        self.write_timeout = None
+
+    def fileno(self):
+        raise OSError("replay port has no file descriptor")
+
+    def write(self, data):
+        data = bytes(data)
+        expected = self.tx[self.written:self.written+len(data)]
+        if data != expected:
+            k = next((i for i in range(len(expected)) if data[i] != expected[i]), len(expected))
+            raise ProtoError(f"replay: request differs from trace at byte {self.written + k}")
+
+        self.written += len(data)
+        return len(data)
+
+    def available(self):
+        # moves responses which are due to pending
+        now = time.monotonic_ns() - self.start
+        while self.rx:
+            needed, t, data = self.rx[0]
+            if needed > self.written or self.realtime and t > now:
+                break
+            self.pending += data
+            self.rx.popleft()
+        return len(self.pending)
+
+    def readinto(self, b):
+        n = min(len(b), self.available())
+        b[:n] = self.pending[:n]
+        del self.pending[:n]
+        return n
+
+    def read(self, n):
+        # returns early instead of waiting for the timeout
+        # when the trace has nothing more for now
+        end = time.monotonic() + (self.timeout or 0)
+        while self.available() < n and self.realtime and self.rx and time.monotonic() < end:
+            time.sleep(0.0005)
+        buf = bytearray(n)
+        k = self.readinto(buf)
+        return bytes(buf[:k])
+
+    def close(self):
+        pass
+
+
+def get_args():
+    p = argparse.ArgumentParser(description="Print a wire trace (debug.py --trace)")
+    p.add_argument("trace", help="trace file")
+    p.add_argument("-n", "--bytes", help="bytes of every chunk to show", type=int, default=16)
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    try:
+        records = load_trace(args.trace)
+    except (OSError, ValueError, struct.error) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    for direction, t, data in records:
+        more = "..." if len(data) > args.bytes else ""
+        print(f"{t / 1e6:12.3f}ms {direction.decode()} {len(data):6}  {data[:args.bytes].hex(' ')}{more}")
@@ -0,0 +1,151 @@
+import json
+
+from Cache import cache_path, write_atomic
+
+# batch sizes tried (image bytes per flush), multiples of 4
+MIN_CHUNK = 0x400
+MAX_CHUNK = 0x100000
+
+# in-flight limits tried after errors, above MAX_WINDOW -- unlimited
+# (an error divides the limit by WINDOW_BACKOFF, success doubles it)
+MIN_WINDOW = 16
+MAX_WINDOW = 0x400
+WINDOW_BACKOFF = 4
+
+# a bigger batch has to be this much faster to be kept
+GAIN = 0.05
+
+# successful batches before the in-flight limit is raised again
+STREAK = 8
+
+class Tuner:
+    """
+    Adaptive batch (chunk) and in-flight (window) sizes of Proto32
+    transfers, set as its <tuner> attribute (None -- fixed sizes).
+
+    Every flush is measured (bytes on the wire per second, time of
+    failed flushes included), batches grow while they get faster,
+    errors halve the batch and cut the in-flight limit.
+    Best settings are kept per port and baud in ~/.cache/debug_uart/tune
+    and are the starting point of the next session.
+
+    port, baud: link the settings belong to
+    chunk: starting batch size (if nothing is stored)
+    window: device receive FIFO size, the in-flight limit never
+            goes above it (None -- unlimited)
+    """
+    def __init__(self, port, baud, chunk, window=None):
+        self.path = cache_path("tune", port, str(baud), suffix=".json")
+
+        self.cap = window
+        self.chunk = chunk
+        self.window = window
+
+        stored = self.load()
+        if stored:
+            self.chunk = stored["chunk"]
+            self.window = self.limit(stored["window"])
+
+        # (chunk, window) -> [bytes, seconds] this session
+        self.measured = {}
+        # last setting that was an improvement, None once settled
+        self.previous = (self.chunk, self.window, 0.0)
+
+        self.transfers = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.streak = 0
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+            if stored["chunk"] % 4 == 0 and stored["chunk"] > 0:
+                return stored
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def save(self):
+        # best setting that succeeded, the backed-off one if all
+        # batches failed, nothing if nothing was measured
+        if not self.measured:
+            return
+
+        best = self.best()
+        if best is None:
+            (chunk, window), rate = (self.chunk, self.window), 0.0
+        else:
+            (chunk, window), rate = best
+        write_atomic(self.path, json.dumps({"chunk": chunk, "window": window, "rate": rate}).encode())
+
+    def limit(self, window):
+        # in-flight limit within the device FIFO size
+        if self.cap is None:
+            return window
+        if window is None:
+            return self.cap
+        return min(window, self.cap)
+
+    def rate(self, setting):
+        nbytes, seconds = self.measured.get(setting, (0, 0.0))
+        return nbytes / seconds if seconds > 0 else 0.0
+
+    def best(self):
+        # ((chunk, window), bytes per second) of the fastest setting
+        # (None -- no batch succeeded)
+        succeeded = [setting for setting, (nbytes, seconds) in self.measured.items() if nbytes]
+        if not succeeded:
+            return None
+        setting = max(succeeded, key=self.rate)
+        return setting, self.rate(setting)
+
+    def done(self, nbytes, seconds):
+        # a flush of <nbytes> (request + response) succeeded
+        setting = (self.chunk, self.window)
+        m = self.measured.setdefault(setting, [0, 0.0])
+        m[0] += nbytes
+        m[1] += seconds
+        self.transfers += 1
+        self.streak += 1
+
+        if self.previous is not None:
+            chunk, window, rate = self.previous
+            if (chunk, window) != setting and self.rate(setting) < rate * (1 + GAIN):
+                # bigger batch didn't help, stay with the last one
+                self.chunk = chunk
+                self.previous = None
+            elif self.chunk < MAX_CHUNK:
+                self.previous = (self.chunk, self.window, self.rate(setting))
+                self.chunk *= 2
+            else:
+                self.previous = None
+
+        if self.streak >= STREAK and self.window is not None and self.window != self.cap:
+            # no errors for a while, allow more in flight
+            self.streak = 0
+            self.window = self.limit(None if self.window * 2 > MAX_WINDOW else self.window * 2)
+
+    def failed(self, seconds, timeout):
+        # a flush failed after <seconds>, its time is lost
+        setting = (self.chunk, self.window)
+        self.measured.setdefault(setting, [0, 0.0])[1] += seconds
+        self.errors += 1
+        self.timeouts += timeout
+        self.streak = 0
+        self.previous = None
+
+        self.chunk = max(MIN_CHUNK, self.chunk // 2)
+        if self.window is None:
+            self.window = self.limit(MAX_WINDOW)
+        else:
+            self.window = self.limit(max(MIN_WINDOW, self.window // WINDOW_BACKOFF))
+
+    def report(self):
+        # human readable summary
+        lines = []
+        lines.append(f"tuning: {self.transfers} batches, {self.errors} errors ({self.timeouts} timeouts)")
+        lines.append(f"  now: chunk {self.chunk}, window {self.window or 'unlimited'}")
+        for (chunk, window) in sorted(self.measured, key=lambda s: (s[0], s[1] or 0)):
+            lines.append(f"  chunk {chunk:8} window {str(window or 'unlimited'):>9}  {self.rate((chunk, window)) / 1024:10.1f} KiB/s")
+        return "\n".join(lines)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import contextlib
+import argparse
+import tempfile
+import subprocess
+
+from Proto import Proto
+from Proto32 import Proto32
+from MemoryImage import MemoryImage
+from IHex import ihex_lines
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# image sizes (bytes) of each protocol, 8bit has 64 KiB address space
+# (sparse images span 4 times their size)
+SIZES = {
+    8:  [0x400, 0x1000, 0x3000],
+    32: [0x400, 0x4000, 0x40000, 0x100000],
+}
+
+# where images start
+ORG = {8: 0x0200, 32: 0x10000000}
+
+# sparse images: <SPARSE_SEG> bytes every <SPARSE_STEP> bytes
+SPARSE_SEG = 64
+SPARSE_STEP = 0x100
+
+OPS = ["write", "read", "verify", "write_verify"]
+
+# slower than baseline by more than this fraction -- regression
+# (differences below MIN_DELTA seconds are noise)
+THRESHOLD = 0.2
+MIN_DELTA = 0.02
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def size_name(size):
+    return f"{size // 0x400}K" if size < 0x100000 else f"{size // 0x100000}M"
+
+
+def workload(bits, kind, size, rnd):
+    # random data image, dense or split into small segments
+    img = MemoryImage()
+    org = ORG[bits]
+    if kind == "dense":
+        img.add(org, rnd.randbytes(size))
+    else:
+        for k in range(size // SPARSE_SEG):
+            img.add(org + k * SPARSE_STEP, rnd.randbytes(SPARSE_SEG))
+    return img
+
+
+class Device:
+    """
+    Simulator (Sim.py) running in its own process,
+    so it doesn't take CPU time of the measured host side
+    """
+    def __init__(self, bits, baud):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "tty")
+        cmd = [sys.executable, os.path.join(HERE, "Sim.py"), "-l", self.path]
+        if bits == 32:
+            cmd.append("--d32")
+        if baud is not None:
+            cmd += ["-b", str(baud)]
+
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        # prints its path when ready
+        self.proc.stdout.readline()
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+        self.tmp.cleanup()
+
+
+def open_port(path, baud, timeout):
+    import serial
+    return serial.Serial(path, baud or 1000000, timeout=timeout)
+
+
+def run_op(prot, op, image):
+    if op == "write":
+        prot.write_memory_image(image)
+    elif op == "read":
+        prot.read_memory_image(image)
+    elif op == "verify":
+        diff = prot.verify_memory_image(image)
+        if len(diff):
+            raise ValueError("verify failed")
+    elif op == "write_verify":
+        diff = prot.write_verify_image(image)
+        if len(diff):
+            raise ValueError("write_verify failed")
+
+
+def bench_python(args, bits, kind, size, baud, image, results):
+    dev = None
+    if args.port:
+        path = args.port
+    else:
+        dev = Device(bits, baud)
+        path = dev.path
+
+    try:
+        ser = open_port(path, baud, args.timeout)
+        prot = Proto32(ser, window=args.window) if bits == 32 else Proto(ser)
+
+        # the image has to be there before read/verify
+        for op in OPS:
+            best = None
+            for _ in range(args.repeat):
+                # progress prints of the protocols are not shown
+                with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+                    t1 = time.perf_counter()
+                    run_op(prot, op, image)
+                    t2 = time.perf_counter()
+                best = t2 - t1 if best is None else min(best, t2 - t1)
+
+            record(results, f"p{bits}/{kind}/{size_name(size)}/{baud or 'max'}/{op}", best, len(image))
+
+        ser.close()
+
+    finally:
+        if dev is not None:
+            dev.close()
+
+
+def bench_cfast(args, kind, size, baud, image, results):
+    # fastupload writes and reads back a hex file (dbgu32 only)
+    with tempfile.TemporaryDirectory() as tmp:
+        hex_path = os.path.join(tmp, "bench.hex")
+        with open(hex_path, "w") as f:
+            for line in ihex_lines(image):
+                f.write(line + "\n")
+
+        dev = None
+        if args.port:
+            path = args.port
+        else:
+            dev = Device(32, baud)
+            path = dev.path
+
+        try:
+            p = subprocess.run([args.cfast, path, hex_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        finally:
+            if dev is not None:
+                dev.close()
+
+    times = dict(re.findall(r"^(write|read): ok ([0-9.]+)s", p.stdout, re.M))
+    if p.returncode != 0 or len(times) != 2:
+        eprint(f"cfast failed ({p.returncode}): {p.stdout[-200:]}")
+        return
+
+    for op, t in times.items():
+        record(results, f"cfast/{kind}/{size_name(size)}/{baud or 'max'}/{op}", float(t), len(image))
+
+
+def record(results, key, seconds, nbytes):
+    results[key] = {"seconds": seconds, "bytes": nbytes}
+    print(f"{key:40} {seconds:8.3f}s {nbytes / seconds / 1024:10.1f} KiB/s")
+
+
+def compare(results, baseline, threshold):
+    # returns keys slower than baseline by more than threshold
+    regressions = []
+    for key, res in results.items():
+        base = baseline["results"].get(key)
+        if base is None:
+            continue
+        ratio = res["seconds"] / base["seconds"]
+        if ratio > 1 + threshold and res["seconds"] - base["seconds"] > MIN_DELTA:
+            regressions.append(key)
+            eprint(f"regression: {key} {base['seconds']:.3f}s -> {res['seconds']:.3f}s ({(ratio-1)*100:+.0f}%)")
+    return regressions
+
+
+def get_args():
+    p = argparse.ArgumentParser(description="Benchmark write/read/verify of both protocols (and cfast)")
+    p.add_argument("--proto", help="protocols to measure", nargs="+", type=int, choices=[8, 32], default=[8, 32])
+    p.add_argument("-s", "--sizes", help="image sizes [KiB] (default: per protocol)", nargs="+", type=int, default=None)
+    p.add_argument("-k", "--kinds", help="dense and/or sparse images", nargs="+", choices=["dense", "sparse"], default=["dense", "sparse"])
+    p.add_argument("-b", "--baud", help="simulated line speeds, 0 -- unlimited", nargs="+", type=int, default=[0, 1000000])
+    p.add_argument("-r", "--repeat", help="runs of each measurement (best is taken)", type=int, default=1)
+    p.add_argument("-w", "--window", help="dbgu32 window [bytes]", type=int, default=None)
+    p.add_argument("-t", "--timeout", help="timeout of serial port [seconds]", type=float, default=1)
+    p.add_argument("-p", "--port", help="use this port (loopback/device) instead of the simulator", default=None)
+    p.add_argument("--cfast", help="fastupload binary (default: cfast/build/fastupload if built)", default=None)
+    p.add_argument("-o", "--output", help="write results as JSON", default=None)
+    p.add_argument("--baseline", help="compare with results JSON, exit 1 on regressions", default=None)
+    p.add_argument("--threshold", help=f"allowed slowdown fraction (default: from baseline or {THRESHOLD})", type=float, default=None)
+    p.add_argument("--seed", help="random seed of image data", type=int, default=0)
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.cfast is None:
+        built = os.path.join(HERE, "cfast", "build", "fastupload")
+        args.cfast = built if os.access(built, os.X_OK) else None
+
+    results = {}
+    for bits in args.proto:
+        sizes = [s * 0x400 for s in args.sizes] if args.sizes else SIZES[bits]
+        for kind in args.kinds:
+            for size in sizes:
+                image = workload(bits, kind, size, random.Random(args.seed))
+                if bits == 8 and image.starts[-1] + len(image.datas[-1]) > 0x10000:
+                    eprint(f"p8/{kind}/{size_name(size)}: doesn't fit in 64 KiB, skipped")
+                    continue
+                
+                for baud in args.baud:
+                    bench_python(args, bits, kind, size, baud or None, image, results)
+                    if bits == 32 and args.cfast:
+                        bench_cfast(args, kind, size, baud or None, image, results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"threshold": args.threshold or THRESHOLD, "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        threshold = args.threshold or baseline.get("threshold", THRESHOLD)
+        if compare(results, baseline, threshold):
+            sys.exit(1)
+        print(f"no regressions (threshold {threshold*100:.0f}%)")
@@ -2,17 +2,41 @@
 
 import os
 import sys
+import mmap
 import time
-import serial
 import argparse
-from intelhex import IntelHex
+import contextlib
+import Broker
 from Proto import Proto
-from Proto32 import Proto32
+from Proto32 import Proto32, CHUNK
 from ProtoError import ProtoError
+from MemoryImage import MemoryImage
+from IHex import load_ihex, ihex_stream
+from Shadow import Shadow
+from Stats import Stats
+from Tuner import Tuner
+from Trace import Trace, TracePort, ReplayPort, load_trace
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+def dump_blocks(prot, pieces, width=8):
+    # "$addr:  xx xx ..." lines of <width> bytes, one text block
+    # per piece (lines may span pieces)
+    line = bytearray()
+    line_addr = None
+    for start, data in pieces:
+        if line_addr is None:
+            line_addr = start
+        line += data
+        n = len(line) - len(line) % width
+        yield "".join(f"${prot.addr_format(line_addr+i)}:  {line[i:i+width].hex(' ')}\n" for i in range(0, n, width))
+        line_addr += n
+        del line[:n]
+    
+    if line:
+        yield f"${prot.addr_format(line_addr)}:  {line.hex(' ')}\n"
+
 def get_args():
     
     p = argparse.ArgumentParser(
@@ -24,6 +48,14 @@ def get_args():
     p.add_argument("-b", "--baudrate", help="baud of serial", required=False, default=115200, metavar="BAUD")
     p.add_argument("-t", "--timeout", help="timeout of serial port [seconds]", required=False, default=1, metavar="T", type=float)
     p.add_argument("--d32", help="use dbgu32 version", required=False, default=False, action='store_true')
+    p.add_argument("--board", help="board name, keeps separate memory shadows of boards used on one port", required=False, default=None)
+    p.add_argument("--stats", help="print wire statistics (requests, bytes, latency) at exit", required=False, default=False, action='store_true')
+    p.add_argument("--trace", help="record wire traffic into a trace file (written at exit)", required=False, default=None, metavar="FILE")
+    p.add_argument("--trace-ring", help="only keep the last N chunks of the trace", required=False, default=None, metavar="N", type=int)
+    p.add_argument("--replay", help="answer from a trace file instead of the port (requests have to match)", required=False, default=None, metavar="FILE")
+    p.add_argument("--realtime", help="replay responses with their recorded timing", required=False, default=False, action='store_true')
+    p.add_argument("--tune", help="adapt batch size and requests in flight to the link, remembered per port and baud (dbgu32 only)", required=False, default=False, action='store_true')
+    p.add_argument("-w", "--window", help="device receive FIFO size [bytes], limits unanswered requests in flight (dbgu32 only)", required=False, default=None, metavar="BYTES", type=int)
 
     subp = p.add_subparsers(required=True, dest="action")
     
@@ -33,10 +65,15 @@ def get_args():
     write.add_argument("-b", "--bin", help="bin file to write", required=False)
     write.add_argument("-m", "--mem", help="raw memory data to write (hex)", required=False, nargs ="*", type=lambda x: int(x, 16))
     write.add_argument("-v", "--verify", help="verify the program after upload", required=False, default=False, action='store_true')
+    write.add_argument("-d", "--delta", help="only send words differing from the memory shadow (last verified write)", required=False, default=False, action='store_true')
+    write.add_argument("-s", "--shadow", help="record verified data in the memory shadow for later --delta writes (implied by --delta)", required=False, default=False, action='store_true')
+    write.add_argument("--no-cache", help="always parse the hex file (don't use parsed image cache)", dest="cache", default=True, action='store_false')
     
     read = subp.add_parser("read", description="read data from memory")
     read.add_argument("-o", "--org", help="origin, where start a read (hex)", required=True, type=lambda x: int(x, 16))
     read.add_argument("-n", "--num", help="number of bytes to read", required=True, type=int)
+    read.add_argument("-f", "--format", help="output format (default: dump)", required=False, default="dump", choices=["dump", "bin", "ihex"])
+    read.add_argument("--output", help="write to file instead of stdout", required=False, default=None, metavar="FILE")
     
     status = subp.add_parser("status", description="check CPU registers")
     
@@ -49,6 +86,9 @@ def get_args():
     reset = subp.add_parser("reset", description="reset the processor")
     reset.add_argument("--pc", help="perform reset routine and read PC (disables freerun)", required=False, default=False, action='store_true')
     
+    shadow = subp.add_parser("shadow", description="show/clear memory shadow")
+    shadow.add_argument("-c", "--clear", help="invalidate the shadow, next --delta write sends everything", required=False, default=False, action='store_true')
+    
     #p.description="Interface the FPGA 6502 via UART\n\nActions:"
     for name, parser in subp.choices.items():
         p.description += f"{name: >10}  {parser.description}\n"
@@ -57,87 +97,143 @@ def get_args():
 
 
 p, args = get_args()
-ser = serial.Serial(args.port, args.baudrate, timeout=args.timeout)
+if args.replay:
+    ser = ReplayPort(load_trace(args.replay), args.realtime)
+    ser.timeout = args.timeout
+else:
+    # port kept open by a running broker (./Broker.py), direct otherwise
+    ser = Broker.connect(args.port, args.baudrate, args.timeout)
+    if ser is None:
+        import serial
+        ser = serial.Serial(args.port, args.baudrate, timeout=args.timeout)
+trace = None
+if args.trace:
+    trace = Trace(args.trace_ring)
+    ser = TracePort(ser, trace)
+tuner = None
 if args.d32:
-    prot = Proto32(ser)
+    prot = Proto32(ser, window=args.window)
+    if args.tune:
+        tuner = Tuner(args.replay or args.port, args.baudrate, CHUNK, args.window)
+        prot.tuner = tuner
 else:
     prot = Proto(ser)
+# replays don't touch the shadow of the real port
+prot.shadow = Shadow(args.replay or args.port, args.board)
+if args.stats:
+    prot.stats = Stats()
 
 try:
     if args.action == "write":
-        data_dict = {}
+        image = MemoryImage()
         
         if args.ihex:
             print(f"loading IntelHex data from {os.path.basename(args.ihex)}")
             
-            ih = IntelHex(args.ihex)
-            for addr in ih.addresses():
-                data_dict[addr] = ih[addr]
+            image = load_ihex(args.ihex, cache=args.cache)
         
         elif args.bin:
             if args.org is None:
                 p.error("-o/--org required with binary data")
                 
             print(f"loading binary data from {os.path.basename(args.bin)} at {args.org:04x}")
-            addr = args.org
             with open(args.bin, "rb") as f:
-                while True:
-                    data = f.read(1)
-                    if not data:
-                        break
-                    
-                    data_dict[addr] = data[0]
-                    addr += 1
+                if os.fstat(f.fileno()).st_size:
+                    # streamed straight from the file in chunks
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    image = MemoryImage.from_buffer(args.org, data)
             
         elif args.mem:
             if args.org is None:
                 p.error("-o/--org required with raw memory")
                 
             print(f"loading raw memory data data from command line at {args.org:04x}")
-            addr = args.org
-            for data in args.mem:
-                data_dict[addr] = data
-                addr += 1
+            image.add(args.org, bytes(args.mem))
                 
         else:
             p.error("no data to write, provide one of --ihex/--bin/--mem")
                 
+        written = image
+        if args.delta:
+            word = 4 if args.d32 else 1
+            image = written.changed(prot.shadow.load(), word)
+            print(f"delta: {len(image)} of {len(written)} bytes differ from shadow")
+        
         print()
-        print("writing data")
+        if args.verify:
+            # writes and read-backs go in the same stream
+            print("writing and verifying data")
+        else:
+            print("writing data")
         t1 = time.time()
-                
-        prot.write_memory_dict(data_dict)
+        
+        if args.verify:
+            if args.delta:
+                # the shadow may be stale (memory written by other
+                # tools), all of the image is read back, not only the delta
+                prot.write_memory_image(image)
+                diff = prot.verify_memory_image(written)
+            else:
+                diff = prot.write_verify_image(image)
+            if len(diff):
+                # bytes next to the image in partially written words
+                # should have kept their values
+                addr = diff.starts[0]
+                expected = f"${written[addr]:02x}" if addr in written else "unchanged"
+                eprint(f"verify error: first error at ${prot.addr_format(addr)}: " \
+                       f"should be {expected}, is ${prot.value_format(diff[addr])}")
+                for start, data in diff.segments():
+                    eprint(f"  ${prot.addr_format(start)} - ${prot.addr_format(start+len(data)-1)}")
+                prot.shadow.invalidate()
+                sys.exit(1)
+        else:
+            prot.write_memory_image(image)
             
         t2 = time.time()
         print(f"OK {t2-t1:.2f}s")
-                
-        if args.verify:
-            print()
-            print("verifying data")
-            t1 = time.time()
-            
-            mem_dict = prot.read_memory_dict(data_dict.keys())
-            for addr, val in data_dict.items():
-                # print(mem_dict[addr], val)
-                if mem_dict[addr] != val:
-                    eprint(f"verify error: first error at ${prot.addr_format(addr)}: " \
-                           f"should be ${val:02x}, is ${prot.value_format(mem_dict[addr])}")
-                    sys.exit(1)
-            
-            t2 = time.time()
-            print(f"OK {t2-t1:.2f}s")
+        
+        if args.verify and (args.delta or args.shadow):
+            prot.shadow.update(written)
+        else:
+            # only verified data is trusted, keeping it is optional
+            # (the shadow is a full copy of the written data)
+            prot.shadow.invalidate()
 
 
     if args.action == "read":
-        addresses = [args.org + i for i in range(args.num)]
-        mem_dict = prot.read_memory_dict(addresses)
+        # streamed in chunks, memory use doesn't depend on --num
+        pieces = prot.read_memory_stream(args.org, args.num)
+        binary = args.format == "bin"
+        t1 = time.time()
         
-        for i, addr in enumerate(addresses):
-            if i % 8 == 0:
-                print(f"\n${prot.addr_format(addr)}:  ", end="")
-            print(f"{prot.value_format(mem_dict[addr])} ", end="")
-        print()
-        print()
+        if args.output:
+            out = open(args.output, "wb" if binary else "w")
+        else:
+            out = contextlib.nullcontext(sys.stdout.buffer if binary else sys.stdout)
+        
+        with out as f:
+            if binary:
+                for start, data in pieces:
+                    f.write(data)
+            elif args.format == "ihex":
+                for line in ihex_stream(pieces):
+                    f.write(line + "\n")
+            else:
+                for block in dump_blocks(prot, pieces):
+                    f.write(block)
+        
+        if args.output:
+            t2 = time.time()
+            print(f"read {args.num} bytes into {args.output} ({args.format}), {t2-t1:.2f}s")
+        
+        
+    if args.action == "shadow":
+        if args.clear:
+            prot.shadow.invalidate()
+            print("shadow cleared")
+        else:
+            for start, data in prot.shadow.load().segments():
+                print(f"${prot.addr_format(start)} - ${prot.addr_format(start+len(data)-1)}  {len(data)} bytes")
         
         
     if args.action == "status":
@@ -167,9 +263,24 @@ try:
             prot.pulse_cpu_reset()
         
 except ProtoError:
+    # memory state unknown
+    prot.shadow.invalidate()
     eprint(f"\n{sys.argv[0]}: protocol error occurred")
     sys.exit(3)
         
-except TimeoutError:
-    eprint(f"\n{sys.argv[0]}: timeout occurred")
+except TimeoutError as e:
+    prot.shadow.invalidate()
+    # exchange timeouts tell how far the batch got
+    eprint(f"\n{sys.argv[0]}: timeout occurred: {e}")
     sys.exit(3)
+
+finally:
+    if trace is not None:
+        trace.save(args.trace)
+    if tuner is not None:
+        tuner.save()
+    if prot.stats is not None:
+        print()
+        prot.print_stats()
+        if tuner is not None:
+            print(tuner.report())
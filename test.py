@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
-from Test import Test
+from Test import Test, compile_all, run_sharded
+from Stats import Stats
 from Proto import Proto
+from Shadow import Shadow
 import serial
 import sys
 
@@ -917,26 +919,44 @@ tests.append(Test("wdc ina",
 
 import sys
 
-if len(sys.argv) != 3:
-    print("Usage:", sys.argv[0], "[serial port] [baud]")
+# --stats prints wire statistics of every board
+argv = [arg for arg in sys.argv if arg != "--stats"]
+stats = len(argv) != len(sys.argv)
+
+if len(argv) < 3:
+    print("Usage:", argv[0], "[--stats] [serial port]... [baud]")
     exit(1)
     
-serial_path = sys.argv[1]
-serial_baud = int(sys.argv[2])
+# tests are spread over all given boards
+serial_paths = argv[1:-1]
+serial_baud = int(argv[-1])
+
+# a board silent for longer times out and takes no more tests
+# (same default as debug.py -t)
+SERIAL_TIMEOUT = 1
 
-prot = Proto(serial.Serial(serial_path, serial_baud))
+prots = {path: Proto(serial.Serial(path, serial_baud, timeout=SERIAL_TIMEOUT)) for path in serial_paths}
+for path, prot in prots.items():
+    # tests write memory and run the CPU, a debug.py --delta
+    # write must not trust the shadow of the port afterwards
+    prot.shadow = Shadow(path)
+if stats:
+    for prot in prots.values():
+        prot.stats = Stats()
 
-passed = 0
-for test in tests:
-    test.compile()
-    test.upload(serial_path, serial_baud)
-    test.run(prot)
-    r = test.verify(prot)
-    if r == 0:
-        passed += 1
+compile_all(tests)
 
-if passed == len(tests):
+failed = run_sharded(tests, prots)
+
+if not failed:
     print(f"all tests passed. count={len(tests)}")
 else:
-    print(f"{len(tests) - passed} tests failed. count={len(tests)}")
-    
+    print(f"{len(failed)} tests failed. count={len(tests)}")
+    for test, path in failed:
+        print(f"  {test.name:20} {path or 'not run'}")
+
+if stats:
+    for path, prot in prots.items():
+        print()
+        print(f"{path}:")
+        prot.print_stats()